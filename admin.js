@@ -211,6 +211,7 @@ function showSection(sectionId) {
 async function loadDashboard() {
     try {
         const response = await fetch(`${API_BASE}/admin/stats`);
+        if (!response.ok) return; // Rate limited: keep the current figures
         const data = await response.json();
 
         // Update Counters
@@ -266,9 +267,11 @@ async function loadDoctors() {
         const tbody = document.getElementById('doctors-list-body');
         tbody.innerHTML = '';
 
+        pruneSelection('doctors', doctors);
         doctors.forEach(doc => {
             const row = `
                 <tr>
+                    <td>${selectionCheckbox('doctors', doc.id)}</td>
                     <td>
                         <img src="https://ui-avatars.com/api/?name=${doc.name}&background=random">
                         <p>${doc.name}</p>
@@ -335,6 +338,67 @@ async function openAddDoctorModal() {
     }
 }
 
+// --- MULTI-SELECT (Doctors & Patients) ---
+// Kept outside the DOM so selections survive the 10s auto-refresh
+const selectedUsers = { doctors: new Set(), patients: new Set() };
+
+function selectionCheckbox(kind, id) {
+    const checked = selectedUsers[kind].has(String(id)) ? 'checked' : '';
+    return `<input type="checkbox" class="select-${kind}" value="${id}" ${checked} onchange="toggleUserSelection('${kind}', this.value, this.checked)">`;
+}
+
+function pruneSelection(kind, rows) {
+    const present = new Set(rows.map(r => String(r.id)));
+    selectedUsers[kind].forEach(id => { if (!present.has(id)) selectedUsers[kind].delete(id); });
+    updateBulkDeleteButton(kind);
+}
+
+function toggleUserSelection(kind, id, checked) {
+    if (checked) selectedUsers[kind].add(String(id));
+    else selectedUsers[kind].delete(String(id));
+    updateBulkDeleteButton(kind);
+}
+
+function toggleSelectAllUsers(kind, checked) {
+    document.querySelectorAll(`.select-${kind}`).forEach(cb => {
+        cb.checked = checked;
+        toggleUserSelection(kind, cb.value, checked);
+    });
+}
+
+function updateBulkDeleteButton(kind) {
+    const btn = document.getElementById(`bulk-delete-${kind}`);
+    if (!btn) return;
+    const count = selectedUsers[kind].size;
+    btn.style.display = count ? 'inline-block' : 'none';
+    btn.innerHTML = `<i class='bx bx-trash'></i> Delete Selected (${count})`;
+}
+
+async function bulkDeleteUsers(kind) {
+    const ids = [...selectedUsers[kind]].map(Number);
+    if (ids.length === 0) return;
+    if (!confirm(`Are you sure you want to delete ${ids.length} ${kind}? This action cannot be undone.`)) return;
+
+    try {
+        // Single request, single transaction on the server
+        const res = await fetch(`${API_BASE}/admin/${kind}/batch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ ids: ids, action: 'delete' })
+        });
+        const data = await res.json();
+        if (!res.ok) throw new Error(data.error || `HTTP ${res.status}`);
+
+        selectedUsers[kind].clear();
+        if (kind === 'doctors') loadDoctors();
+        else loadPatients();
+        loadDashboard(); // Update stats
+    } catch (e) {
+        console.error(`Error deleting ${kind}:`, e);
+        alert(`Error occurred while deleting ${kind}`);
+    }
+}
+
 // --- PATIENT MANAGEMENT ---
 async function loadPatients() {
     try {
@@ -343,9 +407,11 @@ async function loadPatients() {
         const tbody = document.getElementById('patients-list-body');
         tbody.innerHTML = '';
 
+        pruneSelection('patients', patients);
         patients.forEach(p => {
             const row = `
                 <tr>
+                    <td>${selectionCheckbox('patients', p.id)}</td>
                     <td>${p.id}</td>
                     <td>
                         <p>${p.name}</p>
@@ -388,6 +454,11 @@ async function deletePatient(id) {
 
 // INITIALIZATION & AUTO-REFRESH
 document.addEventListener("DOMContentLoaded", () => {
+    // Offline shell caching
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/sw.js').catch(err => console.error("SW registration failed:", err));
+    }
+
     // 1. Force Dashboard Display
     showSection('dashboard');
     loadDashboard();
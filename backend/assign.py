@@ -0,0 +1,161 @@
+import heapq
+import threading
+from collections import OrderedDict
+
+# Doctor auto-assignment at booking time.
+#
+# Each department keeps, per appointment date, a min-heap of its doctors keyed
+# by projected load:
+#   bookings that day (not cancelled / no-show)
+#   + patients still waiting in the live queue (today only)
+#   + BUSY_PENALTY while the doctor is in consultation (today only)
+# Doctors who are Off are not eligible. Ties go to the lowest doctor id.
+#
+# The heaps are per process. The database holds a generation counter per
+# department that every booking, status transition and doctor update bumps.
+# A booking reads the counter under the department's write lock: if it matches
+# the generation the local heaps were built at, they are current and the pick
+# is a heap peek; otherwise another worker changed the department and its heaps
+# are rebuilt from one grouped query. A worker that commits its own booking
+# advances its heaps in place, so a single busy worker rarely rebuilds.
+
+BUSY_PENALTY = 3
+INELIGIBLE_STATUSES = ('Off',)
+UNCOUNTED_STATUSES = ('Cancelled', 'No-Show')  # bookings that no longer add load
+MAX_DAYS_PER_DEPT = 32  # dates kept per department before the oldest heap is dropped
+
+
+def _count(value):
+    # Queue counters written before they were validated may be text or junk
+    try:
+        return max(int(value or 0), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def projected_load(booked, status, queue_current, queue_total, today):
+    """Load a doctor would carry on the day, or None if they cannot take bookings."""
+    if status in INELIGIBLE_STATUSES:
+        return None
+    load = booked
+    if today:
+        load += max(_count(queue_total) - _count(queue_current), 0)
+        if status == 'Busy':
+            load += BUSY_PENALTY
+    return load
+
+
+def changes_load(old_status, new_status=None, delete=False):
+    """True if a status change or delete moves the appointment in or out of the load."""
+    counted = old_status not in UNCOUNTED_STATUSES
+    if delete:
+        return counted
+    return counted != (new_status not in UNCOUNTED_STATUSES)
+
+
+class DoctorHeap:
+    # Lazy deletion: a changed load pushes a new entry and stale ones are
+    # discarded when they reach the top
+    __slots__ = ('loads', 'names', 'heap')
+
+    def __init__(self, doctors):
+        # doctors: {doctor_id: (name, load)}
+        self.loads = {doc_id: load for doc_id, (name, load) in doctors.items()}
+        self.names = {doc_id: name for doc_id, (name, load) in doctors.items()}
+        self.heap = [(load, doc_id) for doc_id, load in self.loads.items()]
+        heapq.heapify(self.heap)
+
+    def peek(self):
+        """Returns (doctor_id, name, load) of the least loaded doctor, or None."""
+        heap = self.heap
+        while heap and self.loads.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        load, doc_id = heap[0]
+        return doc_id, self.names[doc_id], load
+
+    def add(self, doc_id, delta=1):
+        if doc_id in self.loads:
+            self.loads[doc_id] += delta
+            heapq.heappush(self.heap, (self.loads[doc_id], doc_id))
+
+
+class _Department:
+    __slots__ = ('generation', 'days')
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.days = OrderedDict()  # date -> DoctorHeap
+
+
+class LoadBalancer:
+    def __init__(self, max_days=MAX_DAYS_PER_DEPT):
+        self.departments = {}
+        self.max_days = max_days
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.rebuilds = 0
+        self.advanced = 0
+
+    def pick(self, dept, date, generation, load_doctors):
+        """Least loaded doctor for (dept, date) as (doctor_id, name, load), or None.
+
+        `generation` is the department counter read under the write lock;
+        load_doctors() returns {doctor_id: (name, load)} from the database and
+        is only called when the local heap is missing or out of date.
+        """
+        with self.lock:
+            state = self.departments.get(dept)
+            if state is not None and state.generation == generation and date in state.days:
+                state.days.move_to_end(date)
+                self.hits += 1
+                return state.days[date].peek()
+
+        doctors = load_doctors()
+        with self.lock:
+            state = self.departments.get(dept)
+            if state is None or state.generation != generation:
+                state = self.departments[dept] = _Department(generation)
+            heap = state.days[date] = DoctorHeap(doctors)
+            while len(state.days) > self.max_days:
+                state.days.popitem(last=False)
+            self.rebuilds += 1
+            return heap.peek()
+
+    def booked(self, dept, date, doc_id, old_generation, new_generation):
+        """Applies a committed booking locally. Only valid if no one else
+        changed the department in between, i.e. the heaps are still at
+        old_generation; otherwise they are left to be rebuilt."""
+        with self.lock:
+            state = self.departments.get(dept)
+            if state is None or state.generation != old_generation:
+                return
+            state.generation = new_generation
+            if date in state.days and doc_id is not None:
+                state.days[date].add(doc_id)
+            self.advanced += 1
+
+    def invalidate(self, dept=None):
+        with self.lock:
+            if dept is None:
+                self.departments.clear()
+            else:
+                self.departments.pop(dept, None)
+
+    def snapshot(self, dept, date):
+        """{doctor_id: load} currently held for (dept, date), or None."""
+        with self.lock:
+            state = self.departments.get(dept)
+            heap = state.days.get(date) if state else None
+            return dict(heap.loads) if heap else None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "departments": len(self.departments),
+                "heaps": sum(len(s.days) for s in self.departments.values()),
+                "hits": self.hits,
+                "rebuilds": self.rebuilds,
+                "advanced": self.advanced
+            }
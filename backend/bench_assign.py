@@ -0,0 +1,158 @@
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+# Simulation benchmark for doctor auto-assignment.
+#
+# Runs the real /api/book endpoint against an in-memory database: seeds
+# departments of doctors, then books appointments while doctors go Busy/Off
+# and back and patients cancel. Several load balancers stand in for separate
+# worker processes (each booking is served by a random one), so heaps go
+# stale and must be rebuilt exactly as they would across gunicorn workers.
+#
+# Reports booking latency, how evenly bookings spread over the doctors of a
+# department compared with picking a random eligible doctor, heap hit/rebuild
+# counts, and checks every up-to-date heap against a recount from the database.
+#
+#   python bench_assign.py --bookings 5000 --workers 4
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ['JOB_WORKER_MODE'] = 'external'
+os.environ['RATE_LIMIT_ENABLED'] = '0'
+
+import server
+from assign import LoadBalancer
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def spread(counts):
+    # max - min and standard deviation of bookings per doctor
+    values = list(counts.values()) or [0]
+    return max(values) - min(values), statistics.pstdev(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Doctor auto-assignment simulation')
+    parser.add_argument('--departments', type=int, default=6)
+    parser.add_argument('--doctors', type=int, default=5, help='doctors per department')
+    parser.add_argument('--bookings', type=int, default=3000)
+    parser.add_argument('--days', type=int, default=3, help='appointment dates, starting today')
+    parser.add_argument('--workers', type=int, default=4, help='simulated worker processes')
+    parser.add_argument('--churn', type=float, default=0.05, help='chance per booking of a doctor status/queue change')
+    parser.add_argument('--cancel', type=float, default=0.05, help='chance per booking of a cancellation')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    client = server.app.test_client()
+    dates = [(date.today() + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(args.days)]
+
+    # --- seed ---
+    departments = {}  # dept -> {doctor_id: status}
+    tokens = {}  # doctor_id -> session token, for status updates
+    for d in range(args.departments):
+        dept = f"Bench Dept {d}"
+        for i in range(args.doctors):
+            client.post('/api/admin/doctors', json={
+                'name': f"Dr. Bench {d}-{i}", 'mobile': f"8{d:03d}{i:05d}", 'department': dept, 'room': str(i), 'description': ''
+            })
+        rows = server.execute_query('SELECT id, mobile FROM users WHERE role = ? AND department = ?', ('doctor', dept), fetchall=True)
+        departments[dept] = {row['id']: 'Available' for row in rows}
+        for row in rows:
+            tokens[row['id']] = client.post('/api/login', json={'mobile': row['mobile']}).get_json()['token']
+
+    workers = [LoadBalancer() for _ in range(args.workers)]
+    baseline = {}  # appointment id -> doctor id a random pick would have chosen
+    booked = []  # (appointment id, dept, date)
+    latencies = []
+    unassigned = 0
+
+    # --- simulate ---
+    started = time.perf_counter()
+    for n in range(args.bookings):
+        if rng.random() < args.churn:
+            dept = rng.choice(list(departments))
+            doc_id = rng.choice(list(departments[dept]))
+            status = rng.choices(['Available', 'Busy', 'Off'], weights=[6, 3, 1])[0]
+            total = rng.randint(0, 15)
+            departments[dept][doc_id] = status
+            client.post('/api/doctor/status', json={
+                'status': status, 'queue_total': total, 'queue_current': rng.randint(0, total)
+            }, headers={'Authorization': f"Bearer {tokens[doc_id]}"})
+        if booked and rng.random() < args.cancel:
+            apt_id = booked.pop(rng.randrange(len(booked)))[0]
+            client.post('/api/appointments/batch', json={'operations': [{'id': apt_id, 'action': 'cancel'}]})
+            baseline.pop(apt_id, None)
+
+        dept = rng.choice(list(departments))
+        day = rng.choice(dates)
+        server.doctor_loads = rng.choice(workers)
+        t0 = time.perf_counter()
+        res = client.post('/api/book', json={'dept': dept, 'date': day, 'mobile': f"7{n:09d}"}).get_json()
+        latencies.append(time.perf_counter() - t0)
+
+        if res['doctor'] is None:
+            unassigned += 1
+        eligible = [d for d, s in departments[dept].items() if s != 'Off']
+        if eligible:
+            baseline[res['id']] = rng.choice(eligible)
+        booked.append((res['id'], dept, day))
+    elapsed = time.perf_counter() - started
+
+    # --- balance ---
+    smart, rand = [], []
+    for dept, doctors in departments.items():
+        for day in dates:
+            rows = server.execute_query(
+                "SELECT u.id, COUNT(a.id) as n FROM users u LEFT JOIN appointments a ON a.doctor_name = u.name "
+                "AND a.date = ? AND a.status NOT IN ('Cancelled', 'No-Show') WHERE u.role = 'doctor' AND u.department = ? GROUP BY u.id",
+                (day, dept), fetchall=True
+            )
+            smart.append(spread({row['id']: row['n'] for row in rows}))
+            counts = dict.fromkeys(doctors, 0)
+            for apt_id, d, b_day in booked:
+                if d == dept and b_day == day and apt_id in baseline:
+                    counts[baseline[apt_id]] += 1
+            rand.append(spread(counts))
+
+    # --- consistency: heaps at the current generation must match the database ---
+    checked = mismatched = 0
+    conn = server.get_db_connection()
+    try:
+        cur = conn.cursor()
+        for dept in departments:
+            cur.execute(server.SETTING_QUERY, (server.ASSIGN_GEN_PREFIX + dept,))
+            generation = int(cur.fetchone()['value'])
+            for worker in workers:
+                state = worker.departments.get(('', dept))
+                if state is None or state.generation != generation:
+                    continue
+                for day in state.days:
+                    expected = {doc_id: load for doc_id, (name, load) in server.department_loads(cur, dept, day).items()}
+                    checked += 1
+                    if worker.snapshot(('', dept), day) != expected:
+                        mismatched += 1
+    finally:
+        conn.close()
+
+    totals = {key: sum(w.stats()[key] for w in workers) for key in ('hits', 'rebuilds', 'advanced')}
+    ms = [x * 1000 for x in latencies]
+    print(f"Bookings: {args.bookings} over {args.departments} departments x {args.doctors} doctors, "
+          f"{args.days} days, {args.workers} workers ({elapsed:.2f}s, {args.bookings / elapsed:.0f} bookings/s incl. churn)")
+    print(f"Booking latency ms: p50 {percentile(ms, 50):.2f}  p95 {percentile(ms, 95):.2f}  p99 {percentile(ms, 99):.2f}  max {max(ms):.2f}")
+    print(f"Unassigned (every doctor Off): {unassigned}")
+    print("Spread per department/day (max-min bookings, mean stdev):")
+    print(f"  auto-assign : {statistics.mean(s[0] for s in smart):.2f}  {statistics.mean(s[1] for s in smart):.2f}")
+    print(f"  random pick : {statistics.mean(s[0] for s in rand):.2f}  {statistics.mean(s[1] for s in rand):.2f}")
+    print(f"Heaps: {totals['hits']} hits, {totals['rebuilds']} rebuilds, {totals['advanced']} advanced in place")
+    print(f"Consistency: {checked} current heaps checked, {mismatched} mismatched")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+import bisect
+import hashlib
+import html
+import io
+import json
+import os
+import struct
+import time
+import zlib
+
+from storage import Row
+
+# Streaming ZIP archives for record exports.
+#
+# Entries are stored (not compressed) and every CRC and size is known before
+# the first byte is sent, so the archive has a fixed length and layout:
+# ZipStream exposes it as a read-only seekable file that is assembled on the
+# fly from small in-memory parts (headers, rendered reports, the central
+# directory) and the upload files, read a chunk at a time from disk. Being
+# seekable is what lets the server answer Range requests and resume a broken
+# download; the ETag is a hash of the central directory, so any change to the
+# records yields a new ETag and a stale If-Range falls back to a full download.
+
+GENERATED_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # fixed so generated entries are byte-identical across requests
+ZIP32_LIMIT = 0xFFFFFFFF  # offsets and sizes past this would need ZIP64
+UTF8_FLAG = 0x0800
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_END_RECORD = struct.Struct('<IHHHHIIH')
+
+
+class ZipEntry:
+    __slots__ = ('name', 'size', 'crc', 'date_time', 'data', 'path')
+
+    def __init__(self, name, size, crc, date_time, data=None, path=None):
+        self.name = name
+        self.size = size
+        self.crc = crc
+        self.date_time = date_time
+        self.data = data
+        self.path = path
+
+
+def bytes_entry(name, data, date_time=GENERATED_DATE_TIME):
+    return ZipEntry(name, len(data), zlib.crc32(data), date_time, data=data)
+
+
+def file_entry(name, path, crc_cache=None, chunk_size=64 * 1024):
+    """Entry for a file on disk; its CRC is computed once per (path, size, mtime)."""
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    crc = crc_cache.get(key) if crc_cache is not None else None
+    if crc is None:
+        crc = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                crc = zlib.crc32(chunk, crc)
+        if crc_cache is not None:
+            crc_cache.set(key, crc)
+    date_time = time.localtime(st.st_mtime)[:6]
+    if date_time[0] < 1980:
+        date_time = GENERATED_DATE_TIME
+    return ZipEntry(name, st.st_size, crc, date_time, path=path)
+
+
+def json_entry(name, obj):
+    return bytes_entry(name, json.dumps(obj, default=_json_default, indent=2, sort_keys=True).encode('utf-8'))
+
+
+def _json_default(o):
+    if isinstance(o, Row):
+        return o.as_dict()
+    # Postgres timestamps and similar values
+    return str(o)
+
+
+def _dos_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class ZipStream(io.RawIOBase):
+    def __init__(self, entries):
+        self.parts = []  # (start, length, bytes or None, file path or None)
+        self.starts = []
+        central = []
+        offset = 0
+        for entry in entries:
+            name = entry.name.encode('utf-8')
+            dos_time, dos_date = _dos_time(entry.date_time)
+            header = _LOCAL_HEADER.pack(
+                0x04034b50, 20, UTF8_FLAG, 0, dos_time, dos_date,
+                entry.crc, entry.size, entry.size, len(name), 0
+            ) + name
+            central.append(_CENTRAL_HEADER.pack(
+                0x02014b50, 20, 20, UTF8_FLAG, 0, dos_time, dos_date,
+                entry.crc, entry.size, entry.size, len(name), 0, 0, 0, 0, 0, offset
+            ) + name)
+            offset = self._add(offset, header)
+            if entry.path is not None:
+                offset = self._add(offset, None, entry.path, entry.size)
+            else:
+                offset = self._add(offset, entry.data)
+
+        directory = b''.join(central)
+        end = _END_RECORD.pack(0x06054b50, 0, 0, len(central), len(central), len(directory), offset, 0)
+        self.size = self._add(self._add(offset, directory), end)
+        if self.size > ZIP32_LIMIT or len(central) > 0xFFFF:
+            raise ValueError("Export is too large for a ZIP archive")
+        self.etag = hashlib.sha256(directory).hexdigest()[:32]
+
+        self.pos = 0
+        self.file = None
+        self.file_path = None
+
+    def _add(self, offset, data, path=None, length=None):
+        length = len(data) if length is None else length
+        if length:
+            self.starts.append(offset)
+            self.parts.append((offset, length, data, path))
+        return offset + length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, buffer):
+        if self.pos >= self.size:
+            return 0
+        start, length, data, path = self.parts[bisect.bisect_right(self.starts, self.pos) - 1]
+        skip = self.pos - start
+        n = min(len(buffer), length - skip)
+        if path is None:
+            buffer[:n] = data[skip:skip + n]
+        else:
+            if self.file_path != path:
+                self._close_file()
+                self.file = open(path, 'rb')
+                self.file_path = path
+            self.file.seek(skip)
+            read = self.file.readinto(memoryview(buffer)[:n])
+            if read != n:
+                # The file changed after the sizes were fixed; better to fail
+                # the download than send a corrupt archive
+                raise OSError(f"{os.path.basename(path)} changed during export")
+        self.pos += n
+        return n
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = self.file_path = None
+
+    def close(self):
+        self._close_file()
+        super().close()
+
+
+REPORT_FIELDS = [
+    ('Diagnosis', 'diagnosis'),
+    ('Symptoms', 'symptoms'),
+    ('Medicines', 'medicines'),
+    ('Notes', 'notes'),
+    ('Follow-up', 'follow_up_date')
+]
+
+
+def render_report_html(patient, appointment, report, attachment=None):
+    """Standalone HTML page for one report (opens offline from the archive)."""
+    rows = ''.join(
+        f"<tr><th>{label}</th><td>{html.escape(str(report.get(key) or '-'))}</td></tr>"
+        for label, key in REPORT_FIELDS
+    )
+    link = f'<p>Attachment: <a href="../{html.escape(attachment)}">{html.escape(os.path.basename(attachment))}</a></p>' if attachment else ''
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Report #{report['appointment_id']}</title>
+<style>body{{font-family:sans-serif;max-width:720px;margin:2em auto}}th{{text-align:left;padding-right:1em;vertical-align:top}}</style>
+</head>
+<body>
+<h1>Medical Report</h1>
+<p><strong>{html.escape(str(patient.get('name') or ''))}</strong> ({html.escape(str(patient.get('mobile') or ''))})</p>
+<p>Appointment #{appointment['id']} &middot; {html.escape(str(appointment.get('dept') or ''))} &middot; {html.escape(str(appointment.get('date') or ''))} &middot; {html.escape(str(appointment.get('doctor_name') or 'Unassigned'))}</p>
+<table>{rows}</table>
+{link}
+<p><small>Created {html.escape(str(report.get('created_at') or ''))}</small></p>
+</body>
+</html>
+""".encode('utf-8')
@@ -0,0 +1,310 @@
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+
+# Small durable job queue backed by the same database as the app.
+# Handlers enqueue work (upload processing, stats rollups, notifications)
+# and return immediately; workers claim jobs with a visibility timeout so a
+# crashed worker's job becomes claimable again once its lock expires.
+#
+# Postgres: claiming uses FOR UPDATE SKIP LOCKED so many workers never block
+# on each other. SQLite: claiming runs inside BEGIN IMMEDIATE, which takes the
+# database write lock and serialises claimers (the local stand-in). Both come
+# from the storage backend the queue is given, and both are skipped when a
+# plain read finds nothing due, so idle workers polling never take the lock.
+#
+# With a tenant context variable, each job records the tenant that enqueued it
+# and runs with that tenant selected again; one queue serves every tenant.
+
+DEFAULT_VISIBILITY_TIMEOUT = 60  # seconds a claimed job stays invisible
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2  # seconds, doubled on every failed attempt
+LATENCY_SAMPLE_SIZE = 200  # finished jobs used for the latency figures
+DONE_RETENTION = 7 * 24 * 3600  # finished jobs are purged after a week
+FAILED_RETENTION = 30 * 24 * 3600  # failed jobs are kept longer for inspection
+PURGE_INTERVAL = 600  # how often a worker purges old finished jobs
+
+
+class JobQueue:
+    def __init__(self, db, visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT, tenant_var=None):
+        self.db = db
+        self.get_connection = db.connect
+        self.tenant_var = tenant_var
+        self.visibility_timeout = visibility_timeout
+        self.handlers = {}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+
+    def _tenant(self):
+        # '' when tenancy is off so the column can be compared with =
+        return (self.tenant_var.get() if self.tenant_var else None) or ''
+
+    # --- SCHEMA ---
+
+    def create_table(self):
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(self.db.ddl('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id {pk},
+                kind TEXT NOT NULL,
+                tenant TEXT NOT NULL DEFAULT '',
+                payload TEXT,
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER DEFAULT 5,
+                run_at {float} NOT NULL,
+                locked_until {float},
+                locked_by TEXT,
+                last_error TEXT,
+                created_at {float} NOT NULL,
+                started_at {float},
+                finished_at {float}
+            )
+            '''))
+            if 'tenant' not in self.db.table_columns(cur, 'jobs'):
+                cur.execute("ALTER TABLE jobs ADD COLUMN tenant TEXT NOT NULL DEFAULT ''")
+            # Claim scans only look at runnable rows, in run_at order
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    # --- PRODUCER SIDE ---
+
+    def handler(self, kind):
+        """Decorator registering the function that processes jobs of `kind`."""
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def enqueue(self, kind, payload=None, delay=0, max_attempts=DEFAULT_MAX_ATTEMPTS, unique=False):
+        """Adds a job. With unique=True nothing is added if a job of the same
+        kind is already waiting for the same tenant (used for idempotent work
+        like stats rollups)."""
+        now = time.time()
+        tenant = self._tenant()
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            if unique:
+                cur.execute("SELECT id FROM jobs WHERE kind = ? AND tenant = ? AND status = 'queued' LIMIT 1", (kind, tenant))
+                if cur.fetchone():
+                    return
+            cur.execute(
+                'INSERT INTO jobs (kind, tenant, payload, status, attempts, max_attempts, run_at, created_at) VALUES (?, ?, ?, ?, 0, ?, ?, ?)',
+                (kind, tenant, json.dumps(payload or {}), 'queued', max_attempts, now + delay, now)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def enqueue_many(self, kind, payloads, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Adds one job per payload with a single executemany."""
+        if not payloads:
+            return
+        now = time.time()
+        tenant = self._tenant()
+        conn = self.get_connection()
+        try:
+            conn.cursor().executemany(
+                'INSERT INTO jobs (kind, tenant, payload, status, attempts, max_attempts, run_at, created_at) VALUES (?, ?, ?, ?, 0, ?, ?, ?)',
+                [(kind, tenant, json.dumps(p), 'queued', max_attempts, now, now) for p in payloads]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    # --- CONSUMER SIDE ---
+
+    def claim(self):
+        """Claims the next runnable job, or returns None when the queue is idle.
+
+        Runnable means queued and due, or running with an expired lock (the
+        worker that held it died or stalled past the visibility timeout).
+        """
+        now = time.time()
+        locked_until = now + self.visibility_timeout
+        runnable = '''
+                WHERE (status = 'queued' AND run_at <= ?)
+                   OR (status = 'running' AND locked_until < ?)
+        '''
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            # Idle polls stop at a plain read; the write lock is only taken
+            # once there is something to claim
+            cur.execute(f"SELECT 1 AS due FROM jobs {runnable} LIMIT 1", (now, now))
+            if not cur.fetchone():
+                conn.rollback()
+                return None
+
+            self.db.begin_write(cur)
+            cur.execute(f'''
+                SELECT id, kind, tenant, payload, attempts, max_attempts FROM jobs
+                {runnable}
+                ORDER BY run_at
+                LIMIT 1{self.db.for_update_skip}
+            ''', (now, now))
+            row = cur.fetchone()
+            if row:
+                cur.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, locked_by = ?, started_at = ? WHERE id = ?",
+                    (locked_until, self.worker_id, now, row['id'])
+                )
+            conn.commit()
+            if not row:
+                return None
+            job = row.as_dict()
+            job['attempts'] += 1
+            job['payload'] = json.loads(job['payload'] or '{}')
+            return job
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _finish(self, job, error=None):
+        now = time.time()
+        if error is None:
+            query = "UPDATE jobs SET status = 'done', locked_until = NULL, last_error = NULL, finished_at = ? WHERE id = ? AND locked_by = ?"
+            params = (now, job['id'], self.worker_id)
+        elif job['attempts'] >= job['max_attempts']:
+            query = "UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ?, finished_at = ? WHERE id = ? AND locked_by = ?"
+            params = (error, now, job['id'], self.worker_id)
+        else:
+            # Exponential backoff before the next attempt
+            retry_at = now + RETRY_BASE_DELAY * (2 ** (job['attempts'] - 1))
+            query = "UPDATE jobs SET status = 'queued', locked_until = NULL, last_error = ?, run_at = ? WHERE id = ? AND locked_by = ?"
+            params = (error, retry_at, job['id'], self.worker_id)
+
+        conn = self.get_connection()
+        try:
+            conn.cursor().execute(query, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def run_one(self):
+        """Claims and runs a single job. Returns False when nothing was due."""
+        job = self.claim()
+        if not job:
+            return False
+
+        func = self.handlers.get(job['kind'])
+        token = self.tenant_var.set(job['tenant'] or None) if self.tenant_var else None
+        try:
+            if job['attempts'] > job['max_attempts']:
+                # Reclaimed after its lock expired on the final attempt
+                raise TimeoutError("Visibility timeout exceeded on final attempt")
+            if func is None:
+                raise LookupError(f"No handler registered for job kind '{job['kind']}'")
+            func(job['payload'])
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed on attempt {job['attempts']}: {e}")
+            traceback.print_exc()
+            self._finish(job, error=str(e))
+        else:
+            self._finish(job)
+        finally:
+            if token is not None:
+                self.tenant_var.reset(token)
+        return True
+
+    def work(self, poll_interval=1.0):
+        """Runs jobs until stop() is called, sleeping while the queue is idle."""
+        print(f"Job worker {self.worker_id} started")
+        last_purge = 0
+        while not self._stop.is_set():
+            try:
+                if time.time() - last_purge > PURGE_INTERVAL:
+                    self.purge()
+                    last_purge = time.time()
+                if not self.run_one():
+                    self._stop.wait(poll_interval)
+            except Exception as e:
+                print(f"Job worker error: {e}")
+                self._stop.wait(poll_interval)
+
+    def start_thread(self, poll_interval=1.0):
+        """Runs a worker loop in a daemon thread inside the current process."""
+        t = threading.Thread(target=self.work, args=(poll_interval,), daemon=True, name='job-worker')
+        t.start()
+        return t
+
+    def stop(self):
+        self._stop.set()
+
+    def purge(self, older_than=DONE_RETENTION, failed_older_than=FAILED_RETENTION):
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            conn.cursor().execute(
+                "DELETE FROM jobs WHERE (status = 'done' AND finished_at < ?) OR (status = 'failed' AND finished_at < ?)",
+                (now - older_than, now - failed_older_than)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    # --- DASHBOARD ---
+
+    def stats(self):
+        """Queue figures for the current tenant (the whole queue when tenancy is off)."""
+        now = time.time()
+        tenant = self._tenant()
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT kind, status, count(*) AS count FROM jobs WHERE tenant = ? GROUP BY kind, status", (tenant,))
+            depth = {}
+            by_kind = {}
+            for row in cur.fetchall():
+                depth[row['status']] = depth.get(row['status'], 0) + row['count']
+                by_kind.setdefault(row['kind'], {})[row['status']] = row['count']
+
+            cur.execute("SELECT min(created_at) AS oldest FROM jobs WHERE tenant = ? AND status = ? AND run_at <= ?", (tenant, 'queued', now))
+            oldest = cur.fetchone()['oldest']
+
+            cur.execute((
+                "SELECT created_at, started_at, finished_at FROM jobs WHERE tenant = ? AND status = ? ORDER BY finished_at DESC LIMIT ?"
+            ), (tenant, 'done', LATENCY_SAMPLE_SIZE))
+            finished = cur.fetchall()
+        finally:
+            conn.close()
+
+        # Queue latency: time from enqueue to the (last) claim.
+        # Run time: time from that claim to completion.
+        waits = sorted(r['started_at'] - r['created_at'] for r in finished if r['started_at'])
+        runs = sorted(r['finished_at'] - r['started_at'] for r in finished if r['started_at'] and r['finished_at'])
+
+        return {
+            "depth": depth,
+            "by_kind": by_kind,
+            "oldest_queued_age_s": round(now - oldest, 3) if oldest else 0,
+            "latency": {
+                "sample": len(finished),
+                "wait_avg_s": _avg(waits),
+                "wait_p95_s": _pct(waits, 0.95),
+                "run_avg_s": _avg(runs),
+                "run_p95_s": _pct(runs, 0.95)
+            },
+            "handlers": sorted(self.handlers)
+        }
+
+
+def _avg(values):
+    return round(sum(values) / len(values), 3) if values else 0
+
+
+def _pct(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct))
+    return round(sorted_values[idx], 3)
@@ -1,26 +1,132 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, g
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import sqlite3
+from PIL import Image
 import os
+import json
+import secrets
+import re
+import time
+from datetime import datetime, timedelta
+from functools import wraps
 
-try:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
-except ImportError:
-    psycopg2 = None
-    RealDictCursor = None
+from assign import LoadBalancer, UNCOUNTED_STATUSES, changes_load, projected_load
+from cache import LRUCache
+from export import ZipStream, bytes_entry, file_entry, json_entry, render_report_html
+from jobs import JobQueue
+from storage import Row, create_backend, to_json
+from tenants import TenantRouter, UnknownTenant, current_tenant, tenant_var, valid_tenant
+from throttle import TokenBucketLimiter, RedisTokenBucketLimiter, SingleFlight, Counters
 
-# Connect to DB: Use PostgreSQL if DATABASE_URL is set (Render), else SQLite (Local)
+# Connect to DB: Use PostgreSQL if DATABASE_URL is set (Render), else SQLite (Local).
+# STORAGE_BACKEND=memory runs on a throwaway in-memory database (tests/benchmarks).
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.abspath(os.path.join(BASE_DIR, '..'))
 DB_FILE = os.path.join(BASE_DIR, 'hospital.db')
+ARCHIVE_DB_FILE = os.path.join(BASE_DIR, 'hospital_archive.db')
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 DATABASE_URL = os.environ.get('DATABASE_URL')
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND')
+# 'thread' runs a job worker inside each web process (local stand-in),
+# 'external' leaves jobs to `python worker.py` processes.
+JOB_WORKER_MODE = os.environ.get('JOB_WORKER_MODE', 'thread')
+STATS_SNAPSHOT_MAX_AGE = 60  # seconds before admin stats are recomputed live
+CONSULTATION_FEE = 50  # revenue booked per completed appointment
+ROLLUP_BACKFILL_BATCH = 500  # appointments folded into rollups per backfill job
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))  # closed records older than this are archived
+ARCHIVE_BATCH = 200  # rows moved per archive transaction
+ARCHIVE_INTERVAL = 24 * 3600  # seconds between archive passes
+MAX_BATCH_SIZE = 500  # items accepted by one batch request
+# Polled endpoints: each client may burst POLL_BURST requests per route, then
+# POLL_RATE per second. Set RATE_LIMIT_REDIS_URL to share buckets across processes.
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL')
+# Reverse proxies in front of the app (e.g. 1 on Render/Heroku). Only that many
+# X-Forwarded-For entries are trusted; 0 means clients connect directly. Left
+# unset, client addresses are unknown (behind a proxy every request comes from
+# the proxy), so only signed-in clients are rate limited.
+PROXY_HOPS = int(os.environ['PROXY_HOPS']) if os.environ.get('PROXY_HOPS') else None
+POLL_RATE = 1.0
+POLL_BURST = 10
+SECRET_KEY = os.environ.get('SECRET_KEY')
+SECRET_KEY_FILE = os.path.join(BASE_DIR, '.secret_key')  # generated when SECRET_KEY is unset (SQLite only)
+SESSION_MAX_AGE = 7 * 24 * 3600  # seconds a login token stays valid
+USER_CACHE_TTL = 60  # seconds a resolved session user is trusted without a DB lookup
+USER_CACHE_SIZE = 10000
+# Multi-tenant mode: every clinic in TENANTS gets its own SQLite file under
+# TENANT_DATA_DIR (or its own Postgres schema). The tenant comes from the
+# subdomain of TENANT_DOMAIN (<tenant>.clinics.example.com) or, without a
+# domain, from the X-Tenant-ID header set by the proxy.
+MULTI_TENANT = os.environ.get('MULTI_TENANT', '0') == '1'
+TENANTS = {t.strip().lower() for t in os.environ.get('TENANTS', '').split(',') if t.strip()}
+TENANT_DOMAIN = os.environ.get('TENANT_DOMAIN')
+TENANT_HEADER = 'X-Tenant-ID'
+TENANT_DATA_DIR = os.path.join(BASE_DIR, 'tenants')
+TENANT_MAX_OPEN = int(os.environ.get('TENANT_MAX_OPEN', 100))  # tenant databases kept open per process
+TENANT_IDLE_TIMEOUT = 600  # seconds before an unused tenant database is closed
+TENANT_POOL_SIZE = int(os.environ.get('TENANT_POOL_SIZE', 2))  # Postgres connections per tenant
+EXPORT_LINK_MAX_AGE = 4 * 3600  # seconds a record export link (and resuming it) stays valid
+EXPORT_CHUNK_SIZE = 64 * 1024  # bytes sent per write while streaming an export
+EXPORT_CRC_CACHE_SIZE = 10000  # upload files whose checksums are remembered between exports
+
+class RowJSONProvider(DefaultJSONProvider):
+    # Query results are storage.Row objects; serialise them like dicts
+    @staticmethod
+    def default(o):
+        if isinstance(o, Row):
+            return o.as_dict()
+        return DefaultJSONProvider.default(o)
 
 app = Flask(__name__, static_folder=PROJECT_ROOT, static_url_path='')
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+app.json = RowJSONProvider(app)
 CORS(app)
 
+def load_secret_key():
+    # Tokens and export links are signed with this key, so there is no
+    # built-in default. A shared database means a real deployment: refuse to
+    # start. A local SQLite setup gets a random key kept beside the database,
+    # shared by every worker on the host.
+    if SECRET_KEY:
+        return SECRET_KEY
+    if DATABASE_URL:
+        raise RuntimeError("SECRET_KEY must be set when DATABASE_URL is configured")
+    if not os.path.exists(SECRET_KEY_FILE):
+        print(f"WARNING: SECRET_KEY not set, generating one in {SECRET_KEY_FILE}")
+        # Written in full, then linked into place: a worker racing us either
+        # wins the link or reads the winner's complete key
+        tmp = f"{SECRET_KEY_FILE}.{os.getpid()}"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, SECRET_KEY_FILE)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(SECRET_KEY_FILE) as f:
+        return f.read().strip()
+
+SECRET_KEY = load_secret_key()
+
+class SessionError(Exception):
+    pass
+
+@app.errorhandler(SessionError)
+def handle_session_error(e):
+    return jsonify({"error": str(e)}), 401
+
+@app.errorhandler(UnknownTenant)
+def handle_unknown_tenant(e):
+    return jsonify({"error": str(e)}), 404
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     return jsonify({"error": str(e), "type": str(type(e))}), 500
@@ -28,13 +134,113 @@ def handle_exception(e):
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# --- TENANCY ---
+
+def resolve_tenant():
+    # With TENANT_DOMAIN set only the Host counts, so a client cannot reach
+    # another clinic by sending the header; otherwise the proxy sets the header
+    if TENANT_DOMAIN:
+        host = request.host.split(':')[0].lower()
+        suffix = '.' + TENANT_DOMAIN.lower()
+        tenant = host[:-len(suffix)] if host.endswith(suffix) else None
+    else:
+        tenant = request.headers.get(TENANT_HEADER)
+    tenant = (tenant or '').strip().lower()
+    return tenant if valid_tenant(tenant) and tenant in TENANTS else None
+
+@app.before_request
+def select_tenant():
+    if not MULTI_TENANT:
+        return
+    tenant = resolve_tenant()
+    g.tenant_token = tenant_var.set(tenant)
+    # Static pages are shared; anything touching clinic data needs a tenant
+    needs_tenant = request.path.startswith(('/api/', '/uploads/')) and request.path != '/api/health'
+    if tenant is None and needs_tenant:
+        raise UnknownTenant("Unknown tenant")
+
+@app.teardown_request
+def reset_tenant(exc):
+    token = g.pop('tenant_token', None)
+    if token is not None:
+        tenant_var.reset(token)
+
+def tenant_key():
+    # Prefix for every cache and limiter key shared between tenants
+    return current_tenant() or ''
+
+def upload_folder():
+    if not MULTI_TENANT:
+        return UPLOAD_FOLDER
+    folder = os.path.join(UPLOAD_FOLDER, current_tenant())
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+def thumbnail_folder():
+    return os.path.join(upload_folder(), 'thumbs')
+
+def thumbnail_url(file_path):
+    # Set once the process_upload job has produced the preview
+    if file_path and os.path.exists(os.path.join(thumbnail_folder(), file_path + '.jpg')):
+        return f"/uploads/thumbs/{file_path}.jpg"
+    return None
+
+rate_limiter = RedisTokenBucketLimiter(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else TokenBucketLimiter()
+single_flight = SingleFlight()
+poll_counters = Counters()
+
+def client_id():
+    # Signed-in users get their own bucket (a clinic behind one NAT shares an
+    # address). Only a validly signed token counts, so made-up tokens cannot
+    # mint fresh buckets; everyone else is keyed by the address ProxyFix
+    # resolved, or gets None (not limited) while PROXY_HOPS is unset.
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        try:
+            return f"user:{session_serializer.loads(header[7:], max_age=SESSION_MAX_AGE)['uid']}"
+        except (BadSignature, KeyError, TypeError):
+            pass
+    if PROXY_HOPS is None:
+        return None
+    return 'ip:' + (request.remote_addr or 'unknown')
+
+def polled(rate=POLL_RATE, burst=POLL_BURST):
+    """Rate limits a polled GET per client and coalesces identical concurrent requests."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            route = request.url_rule.rule
+            client = client_id() if RATE_LIMIT_ENABLED else None
+            if client:
+                allowed, retry_after = rate_limiter.allow(f"{tenant_key()}|{client}|{route}", rate, burst)
+                if not allowed:
+                    poll_counters.incr(route, 'rejected')
+                    response = jsonify({"error": "Too many requests"})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+                    return response
+
+            # Identical = same tenant, path, query and credentials
+            key = (tenant_key(), request.full_path, request.headers.get('Authorization', ''))
+
+            def run():
+                response = app.make_response(view(*args, **kwargs))
+                return response.get_data(), response.status_code, response.headers.get('Content-Type')
+
+            (body, status, content_type), shared = single_flight.do(key, run)
+            poll_counters.incr(route, 'coalesced' if shared else 'executed')
+            return Response(body, status=status, content_type=content_type)
+        return wrapper
+    return decorator
+
 @app.route('/')
 def serve_index():
     return app.send_static_file('index.html')
 
 @app.route('/uploads/<path:filename>')
 def serve_uploads(filename):
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return send_from_directory(upload_folder(), filename)
 
 @app.route('/admin')
 def serve_admin():
@@ -44,79 +250,112 @@ def serve_admin():
     response.headers["Expires"] = "0"
     return response
 
+@app.route('/sw.js')
+def serve_service_worker():
+    # Browsers must always see the latest worker so cache versions roll out
+    response = app.send_static_file('sw.js')
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 @app.route('/api/health')
 def health_check():
-    db_type = "PostgreSQL" if DATABASE_URL else "SQLite"
-    return jsonify({
+    db_type = db.name
+    health = {
         "status": "running",
         "migration": MIGRATION_STATUS,
         "version": "v2.0.0-hybrid-db",
         "db_type": db_type
-    })
+    }
+    if MULTI_TENANT:
+        health["tenants"] = db.stats()
+    return jsonify(health)
 
 @app.route('/<path:path>')
 def serve_static(path):
     return app.send_static_file(path)
 
-def get_db_connection():
-    if DATABASE_URL:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    else:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-    return conn
+# In multi-tenant mode this database holds only the shared job queue
+control_db = create_backend(DATABASE_URL, DB_FILE, ARCHIVE_DB_FILE, kind=STORAGE_BACKEND)
 
-def execute_query(query, params=(), fetchone=False, fetchall=False, commit=False):
-    conn = get_db_connection()
+def open_tenant_db(tenant):
+    if not os.path.exists(TENANT_DATA_DIR):
+        os.makedirs(TENANT_DATA_DIR)
+    return create_backend(
+        DATABASE_URL,
+        os.path.join(TENANT_DATA_DIR, f'{tenant}.db'),
+        # '.' never appears in a tenant id, so no tenant's file can be another's archive
+        os.path.join(TENANT_DATA_DIR, f'{tenant}.archive.db'),
+        kind=STORAGE_BACKEND,
+        # Used verbatim (quoted) so 'north-clinic' and 'north_clinic' stay apart
+        schema=f"tenant_{tenant}",
+        pool_size=TENANT_POOL_SIZE,
+        # No connection held while the tenant is idle: open tenants x idle
+        # connections would otherwise exhaust Postgres max_connections
+        min_idle=0,
+        statements=control_db.statements
+    )
+
+if MULTI_TENANT:
+    # Schema setup runs the first time each tenant is used in this process
+    db = TenantRouter(control_db, open_tenant_db, setup=lambda tenant: set_up_database(),
+                      max_open=TENANT_MAX_OPEN, idle_timeout=TENANT_IDLE_TIMEOUT)
+else:
+    db = control_db
+
+def get_db_connection(archive=False):
+    # archive=True makes the archive tables reachable (attached file on SQLite)
+    return db.connect(archive=archive)
+
+def execute_query(query, params=(), fetchone=False, fetchall=False, commit=False, archive=False):
+    # Queries use ? placeholders; the backend translates them once per statement
+    conn = get_db_connection(archive=archive)
     try:
-        if DATABASE_URL:
-            # Postgres specific: placeholders are %s
-            query = query.replace('?', '%s')
-            
         cur = conn.cursor()
         cur.execute(query, params)
         
         if commit:
             conn.commit()
-            if DATABASE_URL:
-                # Postgres RETURNING id handling if needed but usually separate
-                pass
             return cur # return cursor for lastrowid access if needed
             
         if fetchone:
-            result = cur.fetchone()
-            return dict(result) if result else None
+            return cur.fetchone()
             
         if fetchall:
-            result = cur.fetchall()
-            return [dict(row) for row in result]
+            return cur.fetchall()
             
     finally:
         conn.close()
 
-def create_schema(conn):
-    print("Creating database schema...")
-    cur = conn.cursor()
-    
+job_queue = JobQueue(control_db, tenant_var=tenant_var)
+
+# Statements behind the polled endpoints, compiled for the backend at startup
+DOCTORS_QUERY = 'SELECT id, name, mobile, department, status, queue_current, queue_total, room_number, description FROM users WHERE role = ?'
+# Join with users to get patient names
+DOCTOR_APPOINTMENTS_QUERY = '''
+    SELECT a.*, u.name as patient_name, u.age as patient_age, u.mobile as patient_mobile
+    FROM appointments a
+    LEFT JOIN users u ON a.user_mobile = u.mobile
+    ORDER BY a.date DESC, a.id DESC
+'''
+QUEUE_QUERY = 'SELECT SUM(queue_current) as current, SUM(queue_total) as total FROM users WHERE role = ?'
+SETTING_QUERY = 'SELECT value FROM system_settings WHERE key = ?'
+# Per-doctor inputs to the projected load, one row per doctor in the department
+DEPARTMENT_LOAD_QUERY = f'''
+    SELECT u.id, u.name, u.status, u.queue_current, u.queue_total, COUNT(a.id) as booked
+    FROM users u
+    LEFT JOIN appointments a ON a.doctor_name = u.name AND a.date = ?
+        AND a.status NOT IN ({', '.join(['?'] * len(UNCOUNTED_STATUSES))})
+    WHERE u.role = 'doctor' AND u.department = ?
+    GROUP BY u.id, u.name, u.status, u.queue_current, u.queue_total
+'''
+db.prepare([DOCTORS_QUERY, DOCTOR_APPOINTMENTS_QUERY, QUEUE_QUERY, SETTING_QUERY, DEPARTMENT_LOAD_QUERY])
+
+# Shared DDL; {pk} and {timestamp} are filled in per backend
+SCHEMA = [
     # 1. USERS TABLE
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        name TEXT NOT NULL,
-        age INTEGER,
-        mobile TEXT UNIQUE NOT NULL,
-        role TEXT DEFAULT 'patient',
-        department TEXT,
-        status TEXT DEFAULT 'Available',
-        queue_current INTEGER DEFAULT 0,
-        queue_total INTEGER DEFAULT 0,
-        room_number TEXT,
-        description TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''' if DATABASE_URL else '''
+    '''
     CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id {pk},
         name TEXT NOT NULL,
         age INTEGER,
         mobile TEXT UNIQUE NOT NULL,
@@ -127,27 +366,13 @@ def create_schema(conn):
         queue_total INTEGER DEFAULT 0,
         room_number TEXT,
         description TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        created_at {timestamp} DEFAULT CURRENT_TIMESTAMP
     )
-    ''')
-
+    ''',
     # 2. APPOINTMENTS TABLE
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS appointments (
-        id SERIAL PRIMARY KEY,
-        dept TEXT NOT NULL,
-        doctor_name TEXT,
-        date TEXT NOT NULL,
-        status TEXT DEFAULT 'Pending',
-        user_mobile TEXT NOT NULL,
-        patient_name TEXT,
-        patient_age INTEGER,
-        report_id TEXT, -- Changed to TEXT to allow 'generated'
-        FOREIGN KEY (user_mobile) REFERENCES users (mobile)
-    )
-    ''' if DATABASE_URL else '''
+    '''
     CREATE TABLE IF NOT EXISTS appointments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id {pk},
         dept TEXT NOT NULL,
         doctor_name TEXT,
         date TEXT NOT NULL,
@@ -155,27 +380,14 @@ def create_schema(conn):
         user_mobile TEXT NOT NULL,
         patient_name TEXT,
         patient_age INTEGER,
-        report_id INTEGER,
+        report_id TEXT, -- TEXT to allow 'generated'
         FOREIGN KEY (user_mobile) REFERENCES users (mobile)
     )
-    ''')
-    
+    ''',
     # 3. REPORTS TABLE
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS reports (
-        id SERIAL PRIMARY KEY,
-        appointment_id INTEGER NOT NULL UNIQUE,
-        diagnosis TEXT,
-        medicines TEXT,
-        notes TEXT,
-        file_path TEXT,
-        symptoms TEXT,
-        follow_up_date TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''' if DATABASE_URL else '''
+    '''
     CREATE TABLE IF NOT EXISTS reports (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id {pk},
         appointment_id INTEGER NOT NULL UNIQUE,
         diagnosis TEXT,
         medicines TEXT,
@@ -183,68 +395,48 @@ def create_schema(conn):
         file_path TEXT,
         symptoms TEXT,
         follow_up_date TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        created_at {timestamp} DEFAULT CURRENT_TIMESTAMP
     )
-    ''')
-    
+    ''',
     # 4. SYSTEM SETTINGS
-    cur.execute('''
+    '''
     CREATE TABLE IF NOT EXISTS system_settings (
         key TEXT PRIMARY KEY,
         value TEXT
     )
-    ''')
-    
+    ''',
     # 5. MESSAGES TABLE
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS messages (
-        id SERIAL PRIMARY KEY,
-        name TEXT,
-        subject TEXT,
-        message TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''' if DATABASE_URL else '''
+    '''
     CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id {pk},
         name TEXT,
         subject TEXT,
         message TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        created_at {timestamp} DEFAULT CURRENT_TIMESTAMP
     )
-    ''')
+    '''
+]
+
+def create_schema(conn):
+    print("Creating database schema...")
+    cur = conn.cursor()
+    for statement in SCHEMA:
+        cur.execute(db.ddl(statement))
 
     conn.commit()
 
     # Seed Data if empty
     cur.execute("SELECT count(*) FROM users")
-    result = cur.fetchone()
-    user_count = result[0] if result else 0
-    
-    # Check if this fetchone returning dict or tuple?
-    # sqlite3.Row -> acts like dict and tuple
-    # psycopg2 -> RealDictCursor -> Dict
-    # But wait, create_schema calls conn.fetchone? No, cur.fetchone
-    # If RealDictCursor, result is {'count': 0} or similar.
-    # To be safe, let's normalize access.
-    
-    if isinstance(user_count, dict):
-        # Depending on query, key might vary.
-        # "SELECT count(*)" -> key "count" usually
-        user_count = list(user_count.values())[0]
+    user_count = cur.fetchone()[0]
 
     if user_count == 0:
         print("Seeding initial data...")
-        placeholders = "%s" if DATABASE_URL else "?"
         
-        # System Settings
-        try:
-             cur.execute(f"INSERT INTO system_settings (key, value) VALUES ({placeholders}, {placeholders})", ('wait_time', '15'))
-        except:
-             pass # might exist
+        # System Settings (might exist)
+        cur.execute("INSERT INTO system_settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO NOTHING", ('wait_time', '15'))
              
         # Demo Patient
-        cur.execute(f"INSERT INTO users (name, age, mobile, role) VALUES ({placeholders}, {placeholders}, {placeholders}, {placeholders})", 
+        cur.execute("INSERT INTO users (name, age, mobile, role) VALUES (?, ?, ?, ?)", 
                    ('Demo User', 25, '9876543210', 'patient'))
         
         doctors = [
@@ -258,7 +450,7 @@ def create_schema(conn):
         
         for name, dept, pwd, room, desc in doctors:
             cur.execute(
-                f"INSERT INTO users (name, age, mobile, role, department, status, queue_current, queue_total, room_number, description) VALUES ({placeholders}, {placeholders}, {placeholders}, 'doctor', {placeholders}, 'Available', 0, 0, {placeholders}, {placeholders})",
+                "INSERT INTO users (name, age, mobile, role, department, status, queue_current, queue_total, room_number, description) VALUES (?, ?, ?, 'doctor', ?, 'Available', 0, 0, ?, ?)",
                 (name, 45, pwd, dept, room, desc)
             )
         conn.commit()
@@ -272,16 +464,7 @@ def run_migrations(conn):
     cur = conn.cursor()
     try:
         # Check reports table for new columns
-        # Logic differs significantly for Postgres vs SQLite logic for PRAGMA
-        
-        if DATABASE_URL:
-             # Postgres migration check
-             cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'reports'")
-             columns = [row['column_name'] for row in cur.fetchall()]
-        else:
-             # SQLite
-             cur.execute("PRAGMA table_info(reports)")
-             columns = [row['name'] for row in cur.fetchall()] # row is sqlite3.Row, has name access
+        columns = db.table_columns(cur, 'reports')
         
         if 'symptoms' not in columns:
             print("Migrating: Adding 'symptoms' to reports request")
@@ -290,8 +473,13 @@ def run_migrations(conn):
         if 'follow_up_date' not in columns:
             print("Migrating: Adding 'follow_up_date' to reports request")
             cur.execute("ALTER TABLE reports ADD COLUMN follow_up_date TEXT")
+
+        # Bookings per doctor and day, counted on every auto-assignment rebuild
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date ON appointments (doctor_name, date)")
             
         conn.commit()
+
+        create_rollup_table(conn)
         print("Migrations check completed.")
         MIGRATION_STATUS = "Success"
         
@@ -299,23 +487,699 @@ def run_migrations(conn):
         print(f"Migration Error: {e}")
         conn.rollback()
         MIGRATION_STATUS = f"Error: {str(e)}"
+        raise
 
-def init_db_if_needed():
+def set_up_database():
+    # Raises on failure, so a tenant is only marked set up once this succeeds
     conn = get_db_connection()
     try:
         cur = conn.cursor()
         # Check if users table exists
         try:
             cur.execute("SELECT 1 FROM users LIMIT 1")
-        except (sqlite3.OperationalError, psycopg2.Error if psycopg2 else sqlite3.OperationalError):
+        except db.Error:
             conn.rollback()
             create_schema(conn)
     
         run_migrations(conn)
+    finally:
+        conn.close()
+
+    # Existing databases get their rollups built once in the background
+    has_rollups = execute_query('SELECT 1 as found FROM appointment_rollups LIMIT 1', fetchone=True)
+    has_appointments = execute_query('SELECT 1 as found FROM appointments LIMIT 1', fetchone=True)
+    if has_appointments and not has_rollups:
+        start_rollup_backfill()
+
+    conn = get_db_connection(archive=True)
+    try:
+        create_archive_tables(conn)
+    finally:
         conn.close()
+    job_queue.enqueue('archive_batch', unique=True)
+
+def init_db_if_needed():
+    # Single-clinic startup: report the error and keep serving
+    try:
+        set_up_database()
     except Exception as e:
         print(f"DB Init Error: {e}")
 
+# --- ANALYTICS ROLLUPS ---
+# appointment_rollups holds one row per (day, dept, doctor) with the number of
+# appointments booked and how many currently sit in each tracked status.
+# Every status transition applies a +1/-1 delta in the same transaction as the
+# change itself, so analytics never scan the appointments table.
+
+ROLLUP_STATUS_COLUMNS = {
+    'Confirmed': 'confirmed',
+    'Cancelled': 'cancelled',
+    'Completed': 'completed',
+    'No-Show': 'no_show'
+}
+ROLLUP_COLUMNS = ['booked', 'confirmed', 'cancelled', 'completed', 'no_show', 'revenue']
+ROLLUP_GROUPS = ['day', 'dept', 'doctor']
+# Batch endpoint actions and the status they set (None deletes the row)
+BATCH_ACTIONS = {'confirm': 'Confirmed', 'cancel': 'Cancelled', 'no_show': 'No-Show', 'delete': None}
+
+def create_rollup_table(conn):
+    cur = conn.cursor()
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS appointment_rollups (
+        day TEXT NOT NULL,
+        dept TEXT NOT NULL,
+        doctor TEXT NOT NULL,
+        booked INTEGER DEFAULT 0,
+        confirmed INTEGER DEFAULT 0,
+        cancelled INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        no_show INTEGER DEFAULT 0,
+        revenue INTEGER DEFAULT 0,
+        PRIMARY KEY (day, dept, doctor)
+    )
+    ''')
+    conn.commit()
+
+def booking_date(value):
+    """ISO date stored with a new booking.
+
+    Clients send YYYY-MM-DD. Older clients (and bookings they queued offline)
+    send toLocaleDateString(), whose day/month order depends on the browser
+    locale and cannot be told apart; those always meant "today", so the
+    server's date is stored instead of guessing.
+    """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (ValueError, TypeError):
+        return datetime.now().strftime('%Y-%m-%d')
+
+def rollup_day(date_str):
+    # New bookings are stored as ISO dates (see booking_date); rows written
+    # before that hold toLocaleDateString() output and are parsed best effort
+    for fmt in ('%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%d-%m-%Y'):
+        try:
+            return datetime.strptime(date_str, fmt).strftime('%Y-%m-%d')
+        except (ValueError, TypeError):
+            continue
+    return date_str or 'unknown'
+
+def rollup_key(apt):
+    return (rollup_day(apt['date']), apt['dept'], apt['doctor_name'] or 'Unassigned')
+
+def rollup_delta(old_status=None, new_status=None, booked=0):
+    delta = dict.fromkeys(ROLLUP_COLUMNS, 0)
+    delta['booked'] = booked
+    if old_status in ROLLUP_STATUS_COLUMNS:
+        delta[ROLLUP_STATUS_COLUMNS[old_status]] -= 1
+    if new_status in ROLLUP_STATUS_COLUMNS:
+        delta[ROLLUP_STATUS_COLUMNS[new_status]] += 1
+    delta['revenue'] = delta['completed'] * CONSULTATION_FEE
+    return delta
+
+def upsert_rollups(cur, deltas):
+    # deltas: {(day, dept, doctor): {column: delta}}
+    cols = ', '.join(ROLLUP_COLUMNS)
+    updates = ', '.join(f"{c} = appointment_rollups.{c} + excluded.{c}" for c in ROLLUP_COLUMNS)
+    query = (
+        f"INSERT INTO appointment_rollups (day, dept, doctor, {cols}) "
+        f"VALUES ({', '.join(['?'] * (3 + len(ROLLUP_COLUMNS)))}) "
+        f"ON CONFLICT (day, dept, doctor) DO UPDATE SET {updates}"
+    )
+    cur.executemany(query, [key + tuple(d[c] for c in ROLLUP_COLUMNS) for key, d in deltas.items()])
+
+def merge_delta(deltas, key, delta):
+    if key in deltas:
+        for c in ROLLUP_COLUMNS:
+            deltas[key][c] += delta[c]
+    else:
+        deltas[key] = dict(delta)
+
+def lock_appointments(cur, ids):
+    """Opens the transition transaction and returns {id: row} for the ids that exist."""
+    query = f"SELECT id, dept, doctor_name, date, status FROM appointments WHERE id IN ({', '.join(['?'] * len(ids))})"
+    # Fixed lock order keeps concurrent batches from deadlocking
+    query += f" ORDER BY id{db.for_update}"
+    db.begin_write(cur)
+    cur.execute(query, list(ids))
+    return {row['id']: row for row in cur.fetchall()}
+
+def record_rollup_deltas(cur, changes):
+    """Applies [(appointment_row, delta)] to the rollups in the caller's transaction."""
+    # While a backfill runs, rows past its cursor are counted by the backfill
+    # itself. Locking the cursor row serialises this with a backfill batch, so
+    # the batch cannot move the cursor past a row whose old status it read.
+    cur.execute(f"SELECT value FROM system_settings WHERE key = ?{db.for_update}", ('rollup_backfill_cursor',))
+    cursor_row = cur.fetchone()
+    backfill_cursor = int(cursor_row['value']) if cursor_row else None
+
+    deltas = {}
+    for apt, delta in changes:
+        if backfill_cursor is None or apt['id'] <= backfill_cursor:
+            merge_delta(deltas, rollup_key(apt), delta)
+    if deltas:
+        upsert_rollups(cur, deltas)
+
+# --- DOCTOR AUTO-ASSIGNMENT ---
+# Heaps live in assign.LoadBalancer; the database keeps one generation counter
+# per department in system_settings ('assign_gen:<dept>'). Bookings take the
+# counter's row lock, so they are serialised per department across workers,
+# and anything that moves a doctor's load bumps it in the same transaction.
+
+ASSIGN_GEN_PREFIX = 'assign_gen:'
+BUMP_GENERATION = "UPDATE system_settings SET value = CAST(CAST(value AS INTEGER) + 1 AS TEXT) WHERE key = ?"
+
+doctor_loads = LoadBalancer()
+
+def lock_department(cur, dept):
+    """Opens the booking transaction and returns the department's generation."""
+    key = ASSIGN_GEN_PREFIX + dept
+    db.begin_write(cur)
+    cur.execute("INSERT INTO system_settings (key, value) VALUES (?, '0') ON CONFLICT (key) DO NOTHING", (key,))
+    cur.execute(f"SELECT value FROM system_settings WHERE key = ?{db.for_update}", (key,))
+    return int(cur.fetchone()['value'])
+
+def touch_departments(cur, depts):
+    """Marks the departments' heaps stale in every worker (caller's transaction)."""
+    # Sorted so concurrent transactions lock the counters in the same order
+    depts = sorted({d for d in depts if d})
+    if depts:
+        cur.executemany(BUMP_GENERATION, [(ASSIGN_GEN_PREFIX + d,) for d in depts])
+
+def touch_doctor_departments(cur, doctor_ids):
+    cur.execute(
+        f"SELECT DISTINCT department FROM users WHERE role = 'doctor' AND id IN ({', '.join(['?'] * len(doctor_ids))})",
+        list(doctor_ids)
+    )
+    touch_departments(cur, [row['department'] for row in cur.fetchall()])
+
+def department_loads(cur, dept, date):
+    """{doctor_id: (name, projected load)} for the doctors who can take a booking."""
+    cur.execute(DEPARTMENT_LOAD_QUERY, (date,) + UNCOUNTED_STATUSES + (dept,))
+    # Live queue and consultation status only matter for bookings made for today
+    today = rollup_day(date) == datetime.now().strftime('%Y-%m-%d')
+    doctors = {}
+    for row in cur.fetchall():
+        load = projected_load(row['booked'], row['status'], row['queue_current'], row['queue_total'], today)
+        if load is not None:
+            doctors[row['id']] = (row['name'], load)
+    return doctors
+
+def apply_appointment_change(apt_id, new_status=None, report_id=None, delete=False):
+    """Applies a status change or delete together with its rollup delta.
+
+    Runs in one transaction with the appointment row locked, so concurrent
+    transitions and a running backfill never double count. Returns the row as
+    it was before the change, or None if the appointment does not exist.
+    """
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        apt = lock_appointments(cur, [apt_id]).get(apt_id)
+        if not apt:
+            conn.rollback()
+            return None
+        change_locked_appointment(cur, apt, new_status, report_id, delete)
+        conn.commit()
+        return apt
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def change_locked_appointment(cur, apt, new_status=None, report_id=None, delete=False):
+    """apply_appointment_change() inside the caller's transaction, for a row
+    it already locked with lock_appointments()."""
+    apt_id = apt['id']
+    if delete:
+        cur.execute("DELETE FROM appointments WHERE id = ?", (apt_id,))
+        delta = rollup_delta(old_status=apt['status'], booked=-1)
+    else:
+        if report_id:
+            cur.execute("UPDATE appointments SET status = ?, report_id = ? WHERE id = ?", (new_status, report_id, apt_id))
+        else:
+            cur.execute("UPDATE appointments SET status = ? WHERE id = ?", (new_status, apt_id))
+        delta = rollup_delta(old_status=apt['status'], new_status=new_status)
+
+    if apt['doctor_name'] and changes_load(apt['status'], new_status, delete):
+        touch_departments(cur, [apt['dept']])
+    record_rollup_deltas(cur, [(apt, delta)])
+
+def apply_appointment_batch(operations):
+    """Applies [(apt_id, action)] in a single transaction.
+
+    Rows are locked once, updated with one statement per target status and
+    one DELETE ... WHERE id IN (...), and the rollup deltas are merged into a
+    single upsert. Returns one result per operation, in order.
+    """
+    ids = sorted({apt_id for apt_id, _ in operations if is_batch_id(apt_id)})
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        rows = lock_appointments(cur, ids) if ids else {}
+
+        results = []
+        changes = []
+        by_status = {}
+        deletes = []
+        touched = []  # departments whose doctor loads change
+        seen = set()
+        for apt_id, action in operations:
+            result = {"id": apt_id, "action": action}
+            apt = rows.get(apt_id) if is_batch_id(apt_id) else None
+            if not is_batch_id(apt_id):
+                result['status'] = 'invalid_id'
+            elif action not in BATCH_ACTIONS:
+                result['status'] = 'invalid_action'
+            elif apt is None:
+                result['status'] = 'not_found'
+            elif apt_id in seen:
+                result['status'] = 'duplicate'
+            else:
+                seen.add(apt_id)
+                new_status = BATCH_ACTIONS[action]
+                if new_status is None:
+                    deletes.append(apt_id)
+                    changes.append((apt, rollup_delta(old_status=apt['status'], booked=-1)))
+                else:
+                    by_status.setdefault(new_status, []).append(apt_id)
+                    changes.append((apt, rollup_delta(old_status=apt['status'], new_status=new_status)))
+                if apt['doctor_name'] and changes_load(apt['status'], new_status, delete=new_status is None):
+                    touched.append(apt['dept'])
+                result['status'] = 'ok'
+            results.append(result)
+
+        for new_status, status_ids in by_status.items():
+            cur.execute(
+                f"UPDATE appointments SET status = ? WHERE id IN ({', '.join(['?'] * len(status_ids))})",
+                [new_status] + status_ids
+            )
+        if deletes:
+            cur.execute(f"DELETE FROM appointments WHERE id IN ({', '.join(['?'] * len(deletes))})", deletes)
+        # Same lock order as bookings: department counters, then the backfill cursor
+        touch_departments(cur, touched)
+        if changes:
+            record_rollup_deltas(cur, changes)
+
+        conn.commit()
+        return results
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def start_rollup_backfill():
+    # Claiming the cursor row decides who starts the backfill: a concurrent
+    # call (or an interrupted backfill) finds it taken and resumes instead
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        db.begin_write(cur)
+        cur.execute(
+            "INSERT INTO system_settings (key, value) VALUES ('rollup_backfill_cursor', '0') ON CONFLICT (key) DO NOTHING"
+        )
+        started = cur.rowcount == 1
+        if started:
+            cur.execute('DELETE FROM appointment_rollups')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    job_queue.enqueue('rollup_backfill', unique=True)
+    return started
+
+# --- ARCHIVAL ---
+# Closed appointments (and their reports) and contact messages older than
+# ARCHIVE_AFTER_DAYS move out of the live tables in small batches, so list and
+# aggregate queries only touch recent rows. On Postgres the archive tables are
+# range-partitioned by month; on SQLite they live in a separate attached file.
+# A patient's own lists always include the archive; clinic-wide lists only
+# when they ask for history (archived=1).
+
+CLOSED_STATUSES = ('Completed', 'Cancelled', 'No-Show')
+APPOINTMENT_COLUMNS = ['id', 'dept', 'doctor_name', 'date', 'status', 'user_mobile', 'patient_name', 'patient_age', 'report_id']
+REPORT_COLUMNS = ['id', 'appointment_id', 'diagnosis', 'medicines', 'notes', 'file_path', 'symptoms', 'follow_up_date', 'created_at']
+MESSAGE_COLUMNS = ['id', 'name', 'subject', 'message', 'created_at']
+ISO_DAY = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+def archive_table(name):
+    return db.archive_table(name)
+
+def create_archive_tables(conn):
+    cur = conn.cursor()
+    if db.supports_partitions:
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS appointments_archive (
+            id INTEGER NOT NULL,
+            dept TEXT NOT NULL,
+            doctor_name TEXT,
+            date TEXT NOT NULL,
+            status TEXT,
+            user_mobile TEXT NOT NULL,
+            patient_name TEXT,
+            patient_age INTEGER,
+            report_id TEXT,
+            day DATE NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (day)
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS reports_archive (
+            id INTEGER NOT NULL,
+            appointment_id INTEGER NOT NULL,
+            diagnosis TEXT,
+            medicines TEXT,
+            notes TEXT,
+            file_path TEXT,
+            symptoms TEXT,
+            follow_up_date TEXT,
+            created_at TIMESTAMP,
+            day DATE NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (day)
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            id INTEGER NOT NULL,
+            name TEXT,
+            subject TEXT,
+            message TEXT,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (created_at)
+        ''')
+    else:
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS archive.appointments (
+            id INTEGER PRIMARY KEY,
+            dept TEXT NOT NULL,
+            doctor_name TEXT,
+            date TEXT NOT NULL,
+            status TEXT,
+            user_mobile TEXT NOT NULL,
+            patient_name TEXT,
+            patient_age INTEGER,
+            report_id TEXT,
+            day TEXT NOT NULL,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS archive.reports (
+            id INTEGER PRIMARY KEY,
+            appointment_id INTEGER NOT NULL UNIQUE,
+            diagnosis TEXT,
+            medicines TEXT,
+            notes TEXT,
+            file_path TEXT,
+            symptoms TEXT,
+            follow_up_date TEXT,
+            created_at TEXT,
+            day TEXT NOT NULL,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS archive.messages (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            subject TEXT,
+            message TEXT,
+            created_at TEXT,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+    # Index names are per-schema on SQLite, so qualify them with the archive schema there
+    idx = '' if db.postgres else 'archive.'
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {idx}idx_appointments_archive_mobile ON {'appointments_archive' if db.postgres else 'appointments'} (user_mobile)")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {idx}idx_reports_archive_apt ON {'reports_archive' if db.postgres else 'reports'} (appointment_id)")
+    if db.postgres:
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_appointments_archive_id ON appointments_archive (id)")
+    conn.commit()
+
+def ensure_month_partitions(cur, table, days):
+    # Postgres only: one partition per calendar month, created on first use
+    for month in sorted({d[:7] for d in days}):
+        start = datetime.strptime(month + '-01', '%Y-%m-%d')
+        end = (start + timedelta(days=32)).replace(day=1)
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_{start:%Y_%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        )
+
+def archive_cutoff():
+    return (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d')
+
+def archive_batch(batch_size=ARCHIVE_BATCH):
+    """Moves one batch of old closed records into the archive.
+
+    Progress is kept in system_settings ('archive_cursor') and advanced in the
+    same transaction as the move, so an interrupted pass resumes where it
+    stopped. Returns True once the pass has covered every table.
+    """
+    cutoff = archive_cutoff()
+    conn = get_db_connection(archive=True)
+    try:
+        cur = conn.cursor()
+        db.begin_write(cur)
+        cur.execute(f"SELECT value FROM system_settings WHERE key = ?{db.for_update}", ('archive_cursor',))
+        row = cur.fetchone()
+        state = json.loads(row['value']) if row else {"stage": "appointments", "last_id": 0}
+
+        if state['stage'] == 'appointments':
+            # SKIP LOCKED leaves rows mid-transition for the next pass instead of waiting on them
+            cur.execute(
+                f"SELECT {', '.join(APPOINTMENT_COLUMNS)} FROM appointments "
+                f"WHERE id > ? AND status IN ({', '.join(['?'] * len(CLOSED_STATUSES))}) ORDER BY id LIMIT ?{db.for_update_skip}",
+                (state['last_id'],) + CLOSED_STATUSES + (batch_size,)
+            )
+            scanned = cur.fetchall()
+            days = {apt['id']: rollup_day(apt['date']) for apt in scanned}
+            # Unparseable dates are never archived
+            old = [apt for apt in scanned if ISO_DAY.match(days[apt['id']]) and days[apt['id']] < cutoff]
+
+            if old:
+                ids = [apt['id'] for apt in old]
+                id_list = ', '.join(['?'] * len(ids))
+                cur.execute(f"SELECT {', '.join(REPORT_COLUMNS)} FROM reports WHERE appointment_id IN ({id_list})", ids)
+                reports = cur.fetchall()
+
+                if db.supports_partitions:
+                    ensure_month_partitions(cur, 'appointments_archive', [days[i] for i in ids])
+                    ensure_month_partitions(cur, 'reports_archive', [days[i] for i in ids])
+
+                cols = APPOINTMENT_COLUMNS + ['day']
+                cur.executemany(
+                    f"INSERT INTO {archive_table('appointments')} ({', '.join(cols)}) VALUES ({', '.join(['?'] * len(cols))})",
+                    [tuple(apt[c] for c in APPOINTMENT_COLUMNS) + (days[apt['id']],) for apt in old]
+                )
+                if reports:
+                    cols = REPORT_COLUMNS + ['day']
+                    cur.executemany(
+                        f"INSERT INTO {archive_table('reports')} ({', '.join(cols)}) VALUES ({', '.join(['?'] * len(cols))})",
+                        [tuple(r[c] for c in REPORT_COLUMNS) + (days[r['appointment_id']],) for r in reports]
+                    )
+                    cur.execute(f"DELETE FROM reports WHERE appointment_id IN ({id_list})", ids)
+                cur.execute(f"DELETE FROM appointments WHERE id IN ({id_list})", ids)
+
+            if len(scanned) < batch_size:
+                state = {"stage": "messages", "last_id": 0}
+            else:
+                state['last_id'] = scanned[-1]['id']
+        else:
+            cur.execute(
+                f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE id > ? AND created_at < ? ORDER BY id LIMIT ?",
+                (state['last_id'], cutoff, batch_size)
+            )
+            old = cur.fetchall()
+            if old:
+                ids = [m['id'] for m in old]
+                if db.supports_partitions:
+                    ensure_month_partitions(cur, 'messages_archive', [str(m['created_at'])[:10] for m in old])
+                cur.executemany(
+                    f"INSERT INTO {archive_table('messages')} ({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join(['?'] * len(MESSAGE_COLUMNS))})",
+                    [tuple(m[c] for c in MESSAGE_COLUMNS) for m in old]
+                )
+                cur.execute(f"DELETE FROM messages WHERE id IN ({', '.join(['?'] * len(ids))})", ids)
+
+            if len(old) < batch_size:
+                state = None
+            else:
+                state['last_id'] = old[-1]['id']
+
+        if state is None:
+            cur.execute("DELETE FROM system_settings WHERE key = ?", ('archive_cursor',))
+        else:
+            cur.execute(
+                "INSERT INTO system_settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                ('archive_cursor', json.dumps(state))
+            )
+        conn.commit()
+        return state is None
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def wants_archive():
+    # Clinic-wide lists read the archive only on request (?archived=1);
+    # per-patient lists always include it
+    return request.args.get('archived') in ('1', 'true')
+
+def with_archive(query, table, alias):
+    """Swaps `table alias` in a query for a union of the live and archive tables."""
+    columns = {'appointments': APPOINTMENT_COLUMNS, 'reports': REPORT_COLUMNS, 'messages': MESSAGE_COLUMNS}[table]
+    cols = ', '.join(columns)
+    union = f"(SELECT {cols} FROM {table} UNION ALL SELECT {cols} FROM {archive_table(table)}) {alias}"
+    return query.replace(f"{table} {alias}", union)
+
+# --- BACKGROUND JOBS ---
+
+THUMBNAIL_SIZE = (256, 256)
+
+def compute_admin_stats():
+    # 1. Counts
+    doc_count = execute_query('SELECT count(*) as count FROM users WHERE role = ?', ('doctor',), fetchone=True)['count']
+    patient_count = execute_query('SELECT count(*) as count FROM users WHERE role = ?', ('patient',), fetchone=True)['count']
+    appt_count = execute_query('SELECT count(*) as count FROM appointments', fetchone=True)['count']
+    
+    # 2. Revenue from the rollups (CONSULTATION_FEE per completed appointment)
+    revenue = int(execute_query('SELECT COALESCE(SUM(revenue), 0) as revenue FROM appointment_rollups', fetchone=True)['revenue'])
+    
+    # 3. Recent Activity (Last 5 appointments)
+    recent = execute_query("SELECT a.id, a.date, a.status, u.name as patient_name FROM appointments a LEFT JOIN users u ON a.user_mobile = u.mobile ORDER BY a.id DESC LIMIT 5", fetchall=True)
+
+    return {
+        "doctors": doc_count,
+        "patients": patient_count,
+        "appointments": appt_count,
+        "revenue": revenue,
+        "recent_activity": recent
+    }
+
+def save_setting(key, value):
+    execute_query(
+        'INSERT INTO system_settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+        (key, value),
+        commit=True
+    )
+
+def queue_stats_rollup():
+    # Many transitions collapse into one pending rollup
+    job_queue.enqueue('stats_rollup', unique=True)
+
+@job_queue.handler('stats_rollup')
+def run_stats_rollup(payload):
+    snapshot = compute_admin_stats()
+    snapshot['generated_at'] = time.time()
+    save_setting('admin_stats_snapshot', json.dumps(snapshot, default=to_json))
+
+@job_queue.handler('rollup_backfill')
+def run_rollup_backfill(payload):
+    # Folds one batch of appointments into the rollups and advances the cursor
+    # in the same transaction, then queues the next batch. Safe to retry.
+    batch_size = payload.get('batch_size', ROLLUP_BACKFILL_BATCH)
+    conn = get_db_connection(archive=True)
+    try:
+        cur = conn.cursor()
+        # Holding the cursor row serialises concurrent batches
+        db.begin_write(cur)
+        cur.execute(f"SELECT value FROM system_settings WHERE key = ?{db.for_update}", ('rollup_backfill_cursor',))
+        cursor_row = cur.fetchone()
+        if not cursor_row:
+            conn.rollback()
+            return
+        last_id = int(cursor_row['value'])
+
+        # Archived appointments still count towards history
+        cur.execute(
+            "SELECT id, dept, doctor_name, date, status FROM ("
+            " SELECT id, dept, doctor_name, date, status FROM appointments WHERE id > ?"
+            " UNION ALL"
+            f" SELECT id, dept, doctor_name, date, status FROM {archive_table('appointments')} WHERE id > ?"
+            ") t ORDER BY id LIMIT ?",
+            (last_id, last_id, batch_size)
+        )
+        rows = cur.fetchall()
+
+        deltas = {}
+        for apt in rows:
+            merge_delta(deltas, rollup_key(apt), rollup_delta(new_status=apt['status'], booked=1))
+        if deltas:
+            upsert_rollups(cur, deltas)
+
+        if len(rows) < batch_size:
+            cur.execute("DELETE FROM system_settings WHERE key = ?", ('rollup_backfill_cursor',))
+        else:
+            cur.execute("UPDATE system_settings SET value = ? WHERE key = ?", (str(rows[-1]['id']), 'rollup_backfill_cursor'))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if len(rows) < batch_size:
+        print("Rollup backfill completed.")
+        queue_stats_rollup()
+    else:
+        job_queue.enqueue('rollup_backfill', payload)
+
+@job_queue.handler('archive_batch')
+def run_archive_batch(payload):
+    if archive_batch(payload.get('batch_size', ARCHIVE_BATCH)):
+        print("Archive pass completed.")
+        job_queue.enqueue('archive_batch', delay=ARCHIVE_INTERVAL, unique=True)
+    else:
+        job_queue.enqueue('archive_batch', payload)
+
+@job_queue.handler('process_upload')
+def process_upload(payload):
+    # Image attachments get a JPEG preview shown in the report views. Pillow
+    # cannot rasterise PDFs; those keep a plain attachment link.
+    filename = payload['filename']
+    if os.path.splitext(filename)[1].lower() not in ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'):
+        return
+
+    thumbs = thumbnail_folder()
+    if not os.path.exists(thumbs):
+        os.makedirs(thumbs)
+    with Image.open(os.path.join(upload_folder(), filename)) as img:
+        img.thumbnail(THUMBNAIL_SIZE)
+        img.convert('RGB').save(os.path.join(thumbs, filename + '.jpg'), 'JPEG')
+
+@job_queue.handler('notify')
+def send_notification(payload):
+    apt = execute_query(
+        'SELECT a.id, a.dept, a.date, u.name, u.mobile FROM appointments a LEFT JOIN users u ON a.user_mobile = u.mobile WHERE a.id = ?',
+        (payload['appointment_id'],), fetchone=True
+    )
+    if not apt:
+        return
+    # No SMS/e-mail provider is configured yet, so notifications are logged
+    print(f"NOTIFY {apt['mobile']}: Appointment #{apt['id']} ({apt['dept']}, {apt['date']}) is now {payload['status']}")
+
+def on_appointment_changed(apt_id, status=None):
+    queue_stats_rollup()
+    if status:
+        job_queue.enqueue('notify', {"appointment_id": apt_id, "status": status})
+
+def on_appointments_changed(results):
+    # Batch counterpart: one rollup and all notifications in a single insert
+    applied = [r for r in results if r['status'] == 'ok']
+    if not applied:
+        return
+    queue_stats_rollup()
+    job_queue.enqueue_many('notify', [
+        {"appointment_id": r['id'], "status": BATCH_ACTIONS[r['action']]}
+        for r in applied if BATCH_ACTIONS[r['action']]
+    ])
+
 
 
 @app.route('/api/login', methods=['POST'])
@@ -331,7 +1195,7 @@ def login():
     if user:
         # Existing User (Patient or Doctor)
         # Check if Admin (Hardcoded for now based on plans, or just role check)
-        return jsonify({"status": "success", "user": user})
+        return jsonify({"status": "success", "user": user, "token": issue_token(user)})
     else:
         # New Patient Registration
         if 'name' not in data or 'age' not in data:
@@ -353,21 +1217,74 @@ def login():
         # Let's simple query back.
         user_new = execute_query('SELECT * FROM users WHERE mobile = ?', (mobile,), fetchone=True)
         
-        return jsonify({"status": "success", "user": user_new})
+        return jsonify({"status": "success", "user": user_new, "token": issue_token(user_new)})
+
+# --- SESSIONS ---
+# Login issues a signed, stateless token carrying the user id. Requests send it
+# as `Authorization: Bearer <token>`; the resolved user row is kept in an
+# LRU+TTL cache so authenticated requests skip the users-table lookup.
+# Deleting a user evicts it here at once; other processes drop it within
+# USER_CACHE_TTL, after which the token no longer resolves.
+
+session_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='session')
+user_cache = LRUCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+def issue_token(user):
+    user_cache.set((tenant_key(), user['id']), user)
+    return session_serializer.dumps({"uid": user['id'], "tid": current_tenant()})
+
+def current_user():
+    """Returns the session user, None without a token, or raises SessionError."""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    try:
+        data = session_serializer.loads(header[7:], max_age=SESSION_MAX_AGE)
+    except SignatureExpired:
+        raise SessionError("Session expired, please log in again")
+    except BadSignature:
+        raise SessionError("Invalid session token")
+
+    # A token is only good for the clinic that issued it
+    if data.get('tid') != current_tenant():
+        raise SessionError("Invalid session token")
+
+    key = (tenant_key(), data['uid'])
+    user = user_cache.get(key)
+    if user is None:
+        user = execute_query('SELECT * FROM users WHERE id = ?', (data['uid'],), fetchone=True)
+        if not user:
+            raise SessionError("User no longer exists")
+        user_cache.set(key, user)
+    return user
+
+def require_user():
+    """current_user() for routes that act on the caller's own records."""
+    user = current_user()
+    if user is None:
+        raise SessionError("Please log in")
+    return user
+
+def invalidate_user(user_id):
+    # Drops the cached row; for a deleted user this revokes their sessions
+    try:
+        user_cache.delete((tenant_key(), int(user_id)))
+    except (TypeError, ValueError):
+        pass
 
 # --- PUBLIC APIS ---
 
 @app.route('/api/doctors', methods=['GET'])
+@polled()
 def get_doctors():
     # Added mobile to query so frontend can use it for login ID
-    doctors = execute_query('SELECT id, name, mobile, department, status, queue_current, queue_total, room_number, description FROM users WHERE role = ?', ('doctor',), fetchall=True)
+    doctors = execute_query(DOCTORS_QUERY, ('doctor',), fetchall=True)
     return jsonify(doctors)
 
 @app.route('/api/appointments', methods=['GET'])
 def get_appointments():
-    mobile = request.args.get('mobile')
-    if not mobile:
-        return jsonify([])
+    # Only the signed-in patient's own appointments
+    mobile = require_user()['mobile']
     
     # Join with reports to get follow_up_date
     query = '''
@@ -377,27 +1294,52 @@ def get_appointments():
         WHERE a.user_mobile = ? 
         ORDER BY a.id DESC
     '''
-    appointments = execute_query(query, (mobile,), fetchall=True)
+    query = with_archive(with_archive(query, 'appointments', 'a'), 'reports', 'r')
+    appointments = execute_query(query, (mobile,), fetchall=True, archive=True)
     
     return jsonify(appointments)
 
 @app.route('/api/book', methods=['POST'])
 def book_appointment():
     data = request.json
+    user = current_user()
+    mobile = user['mobile'] if user else data['mobile']
+    dept, date = data['dept'], booking_date(data.get('date'))
     
-    execute_query(
-        'INSERT INTO appointments (dept, date, status, user_mobile, report_id, patient_name, patient_age) VALUES (?, ?, ?, ?, ?, ?, ?)',
-        (data['dept'], data['date'], 'Scheduled', data['mobile'], None, data.get('patient_name'), data.get('patient_age')),
-        commit=True
-    )
-    
-    # We need the ID for UI? The frontend might not use it immediately, but let's try to get it.
-    # For now, return status success is enough as per old code logic (old code returned new_id, but frontend might ignore it).
-    # To be safe, let's select max id for this user.
-    last_apt = execute_query('SELECT id FROM appointments WHERE user_mobile = ? ORDER BY id DESC LIMIT 1', (data['mobile'],), fetchone=True)
-    new_id = last_apt['id'] if last_apt else 0
+    # Pick the least loaded doctor and insert under the department's lock, so
+    # two workers never both hand out the same slot
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        generation = lock_department(cur, dept)
+        doctor = doctor_loads.pick((tenant_key(), dept), date, generation, lambda: department_loads(cur, dept, date))
+        cur.execute(
+            'INSERT INTO appointments (dept, doctor_name, date, status, user_mobile, report_id, patient_name, patient_age) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (dept, doctor[1] if doctor else None, date, 'Scheduled', mobile, None, data.get('patient_name'), data.get('patient_age'))
+        )
+        # To be safe, let's select max id for this user.
+        cur.execute('SELECT id FROM appointments WHERE user_mobile = ? ORDER BY id DESC LIMIT 1', (mobile,))
+        last_apt = cur.fetchone()
+        # The booking's rollup delta commits with the row, so no transition
+        # can slip in between and be counted against the wrong status
+        record_rollup_deltas(cur, [(
+            {'id': last_apt['id'], 'date': date, 'dept': dept, 'doctor_name': doctor[1] if doctor else None},
+            rollup_delta(new_status='Scheduled', booked=1)
+        )])
+        touch_departments(cur, [dept])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    # Committed: this worker's heap takes the booking without a rebuild
+    doctor_loads.booked((tenant_key(), dept), date, doctor[0] if doctor else None, generation, generation + 1)
+
+    new_id = last_apt['id']
+    on_appointment_changed(new_id)
     
-    return jsonify({"status": "success", "id": new_id})
+    return jsonify({"status": "success", "id": new_id, "doctor": doctor[1] if doctor else None})
 
 # --- DOCTOR API ---
 
@@ -428,29 +1370,24 @@ def get_all_appointments_admin():
     return jsonify([dict(row) for row in results])
 
 @app.route('/api/doctor/appointments', methods=['GET'])
+@polled()
 def get_all_appointments():
-    # Join with users to get patient names
-    query = '''
-        SELECT a.*, u.name as patient_name, u.age as patient_age, u.mobile as patient_mobile
-        FROM appointments a
-        LEFT JOIN users u ON a.user_mobile = u.mobile
-        ORDER BY a.date DESC, a.id DESC
-    '''
-    appointments = execute_query(query, fetchall=True)
+    appointments = execute_query(DOCTOR_APPOINTMENTS_QUERY, fetchall=True)
     return jsonify(appointments)
 
 @app.route('/api/doctor/patient_history/<mobile>', methods=['GET'])
 def get_patient_history(mobile):
     # Fetch all appointments for this mobile that are completed
     query = '''
-        SELECT a.*, r.diagnosis, r.medicines, r.symptoms, r.follow_up_date 
+        SELECT a.*, r.diagnosis, r.medicines, r.symptoms, r.follow_up_date, r.file_path
         FROM appointments a
         LEFT JOIN reports r ON a.report_id = 'generated' AND a.id = r.appointment_id
         WHERE a.user_mobile = ?
         ORDER BY a.date DESC
     '''
-    history = execute_query(query, (mobile,), fetchall=True)
-    return jsonify(history)
+    query = with_archive(with_archive(query, 'appointments', 'a'), 'reports', 'r')
+    history = execute_query(query, (mobile,), fetchall=True, archive=True)
+    return jsonify([dict(row.as_dict(), thumbnail_url=thumbnail_url(row['file_path'])) for row in history])
 
 @app.route('/api/doctor/report', methods=['POST'])
 def save_report():
@@ -463,74 +1400,250 @@ def save_report():
         data = request.get_json(silent=True) or {}
         file = None
 
-    apt_id = data['appointment_id']
-    file_path = None
+    apt_id = batch_id(data.get('appointment_id'))
+    if not is_batch_id(apt_id):
+        return jsonify({"error": "appointment_id must be an integer"}), 400
+    file_path = secure_filename(file.filename) if file else None
 
-    if file:
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(UPLOAD_FOLDER, filename))
-        file_path = filename
-    
-    # Check if report exists
-    existing = execute_query('SELECT id FROM reports WHERE appointment_id = ?', (apt_id,), fetchone=True)
-    
-    if existing:
-        if file_path:
-            execute_query(
-                'UPDATE reports SET diagnosis = ?, medicines = ?, notes = ?, file_path = ? WHERE appointment_id = ?',
-                (data['diagnosis'], data['medicines'], data['notes'], file_path, apt_id),
-                commit=True
-            )
+    # Report, status change and rollup delta commit together with the
+    # appointment locked, so concurrent saves cannot both insert a report
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        apt = lock_appointments(cur, [apt_id]).get(apt_id)
+        if not apt:
+            conn.rollback()
+            return jsonify({"error": "Appointment not found"}), 404
+        if file:
+            file.save(os.path.join(upload_folder(), file_path))
+
+        # Check if report exists
+        cur.execute('SELECT id FROM reports WHERE appointment_id = ?', (apt_id,))
+        existing = cur.fetchone()
+        if existing:
+            if file_path:
+                cur.execute(
+                    'UPDATE reports SET diagnosis = ?, medicines = ?, notes = ?, file_path = ? WHERE appointment_id = ?',
+                    (data['diagnosis'], data['medicines'], data['notes'], file_path, apt_id)
+                )
+            else:
+                cur.execute(
+                    'UPDATE reports SET diagnosis = ?, medicines = ?, notes = ?, symptoms = ?, follow_up_date = ? WHERE appointment_id = ?',
+                    (data['diagnosis'], data['medicines'], data['notes'], data.get('symptoms'), data.get('follow_up_date'), apt_id)
+                )
         else:
-            execute_query(
-                'UPDATE reports SET diagnosis = ?, medicines = ?, notes = ?, symptoms = ?, follow_up_date = ? WHERE appointment_id = ?',
-                (data['diagnosis'], data['medicines'], data['notes'], data.get('symptoms'), data.get('follow_up_date'), apt_id),
-                commit=True
+            cur.execute(
+                'INSERT INTO reports (appointment_id, diagnosis, medicines, notes, file_path, symptoms, follow_up_date) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (apt_id, data['diagnosis'], data['medicines'], data['notes'], file_path, data.get('symptoms'), data.get('follow_up_date'))
             )
-    else:
-        execute_query(
-            'INSERT INTO reports (appointment_id, diagnosis, medicines, notes, file_path, symptoms, follow_up_date) VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (apt_id, data['diagnosis'], data['medicines'], data['notes'], file_path, data.get('symptoms'), data.get('follow_up_date')),
-            commit=True
-        )
-        
-        # Update Appointment status
-        execute_query(
-            "UPDATE appointments SET status = 'Completed', report_id = ? WHERE id = ?", 
-            ('generated', apt_id),
-            commit=True
-        )
+            # Update Appointment status
+            change_locked_appointment(cur, apt, 'Completed', report_id='generated')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if file_path:
+        job_queue.enqueue('process_upload', {"filename": file_path})
+    if not existing:
+        on_appointment_changed(apt_id, 'Completed')
 
     return jsonify({"status": "success"})
 
 @app.route('/api/report/<int:apt_id>', methods=['GET'])
 def get_report(apt_id):
     report = execute_query('SELECT * FROM reports WHERE appointment_id = ?', (apt_id,), fetchone=True)
+    if not report:
+        # Reports of archived appointments are still reachable by id
+        report = execute_query(
+            f"SELECT {', '.join(REPORT_COLUMNS)} FROM {archive_table('reports')} WHERE appointment_id = ?",
+            (apt_id,), fetchone=True, archive=True
+        )
     
     if report:
-        return jsonify(report)
+        return jsonify(dict(report.as_dict(), thumbnail_url=thumbnail_url(report.get('file_path'))))
     else:
         return jsonify({"error": "Report not found"}), 404
 
+# --- RECORD EXPORTS ---
+# A patient (or a doctor) asks for an export link; the link streams a ZIP of
+# the patient's appointments, every report as JSON and HTML and the attached
+# upload files. The ZIP is built on the fly with a fixed layout, so it never
+# touches a temp file and a broken download resumes with a Range request.
+
+export_serializer = URLSafeTimedSerializer(SECRET_KEY, salt='export')
+# Checksums of upload files keyed by (path, size, mtime), so repeated and
+# resumed exports do not re-read every attachment before streaming
+export_crc_cache = LRUCache(maxsize=EXPORT_CRC_CACHE_SIZE, ttl=EXPORT_LINK_MAX_AGE)
+
+def patient_export_entries(mobile):
+    """ZIP entries for one patient's records (live and archived), or None."""
+    patient = execute_query('SELECT id, name, age, mobile, created_at FROM users WHERE mobile = ?', (mobile,), fetchone=True)
+    appointments = execute_query(
+        with_archive('SELECT a.* FROM appointments a WHERE a.user_mobile = ? ORDER BY a.id', 'appointments', 'a'),
+        (mobile,), fetchall=True, archive=True
+    )
+    if not patient and not appointments:
+        return None
+    # Guest bookings have no users row
+    patient = patient or {"mobile": mobile}
+
+    query = '''
+        SELECT r.* FROM reports r
+        JOIN appointments a ON a.id = r.appointment_id
+        WHERE a.user_mobile = ?
+        ORDER BY r.appointment_id
+    '''
+    reports = execute_query(
+        with_archive(with_archive(query, 'reports', 'r'), 'appointments', 'a'),
+        (mobile,), fetchall=True, archive=True
+    )
+
+    entries = [json_entry('appointments.json', {"patient": patient, "appointments": appointments})]
+    by_id = {apt['id']: apt for apt in appointments}
+    folder = upload_folder()
+    for report in reports:
+        apt_id = report['appointment_id']
+        attachment = path = None
+        if report['file_path']:
+            filename = os.path.basename(report['file_path'])
+            path = os.path.join(folder, filename)
+            if os.path.isfile(path):
+                attachment = f"files/{apt_id}/{filename}"
+        entries.append(json_entry(f"reports/{apt_id}.json", report))
+        entries.append(bytes_entry(f"reports/{apt_id}.html", render_report_html(patient, by_id[apt_id], report, attachment)))
+        if attachment:
+            entries.append(file_entry(attachment, path, export_crc_cache))
+    return entries
+
+@app.route('/api/patients/<mobile>/export', methods=['POST'])
+def create_export_link(mobile):
+    # Patients export their own records, doctors any patient's
+    user = current_user()
+    if not user:
+        return jsonify({"error": "Login required"}), 401
+    if user['role'] != 'doctor' and user['mobile'] != mobile:
+        return jsonify({"error": "Not allowed"}), 403
+
+    token = export_serializer.dumps({"mobile": mobile, "tid": current_tenant()})
+    # Plain link so the browser's download manager can fetch and resume it
+    return jsonify({"url": f"/api/exports/{token}", "expires_in": EXPORT_LINK_MAX_AGE})
+
+@app.route('/api/exports/<token>', methods=['GET'])
+def download_export(token):
+    try:
+        data = export_serializer.loads(token, max_age=EXPORT_LINK_MAX_AGE)
+    except SignatureExpired:
+        return jsonify({"error": "Export link expired"}), 410
+    except BadSignature:
+        return jsonify({"error": "Export not found"}), 404
+    if data.get('tid') != current_tenant():
+        return jsonify({"error": "Export not found"}), 404
+
+    entries = patient_export_entries(data['mobile'])
+    if entries is None:
+        return jsonify({"error": "Export not found"}), 404
+    try:
+        stream = ZipStream(entries)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 413
+
+    response = Response(
+        wrap_file(request.environ, stream, buffer_size=EXPORT_CHUNK_SIZE),
+        mimetype='application/zip',
+        direct_passthrough=True
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename="records-{secure_filename(data["mobile"])}.zip"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    response.content_length = stream.size
+    response.set_etag(stream.etag)
+    try:
+        # Handles Range / If-Range (resume) and If-None-Match
+        return response.make_conditional(request, accept_ranges=True, complete_length=stream.size)
+    except RequestedRangeNotSatisfiable:
+        stream.close()
+        response = jsonify({"error": "Requested range not satisfiable"})
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{stream.size}'
+        return response
+
 @app.route('/api/appointments/<int:apt_id>', methods=['DELETE'])
 def delete_appointment(apt_id):
-    execute_query('DELETE FROM appointments WHERE id = ?', (apt_id,), commit=True)
+    apply_appointment_change(apt_id, delete=True)
+    on_appointment_changed(apt_id)
     return jsonify({"status": "deleted"})
 
 @app.route('/api/appointments/<int:apt_id>/confirm', methods=['POST'])
 def confirm_appointment(apt_id):
-    execute_query("UPDATE appointments SET status = 'Confirmed' WHERE id = ?", (apt_id,), commit=True)
+    apply_appointment_change(apt_id, 'Confirmed')
+    on_appointment_changed(apt_id, 'Confirmed')
     return jsonify({"status": "success"})
 
 @app.route('/api/appointments/<int:apt_id>/cancel', methods=['POST'])
 def cancel_appointment(apt_id):
-    execute_query("UPDATE appointments SET status = 'Cancelled' WHERE id = ?", (apt_id,), commit=True)
+    apply_appointment_change(apt_id, 'Cancelled')
+    on_appointment_changed(apt_id, 'Cancelled')
     return jsonify({"status": "success"})
 
+@app.route('/api/appointments/<int:apt_id>/no_show', methods=['POST'])
+def mark_no_show(apt_id):
+    apply_appointment_change(apt_id, 'No-Show')
+    on_appointment_changed(apt_id, 'No-Show')
+    return jsonify({"status": "success"})
+
+def read_batch_request():
+    """Parses {"ids": [...], "action": ...} or {"operations": [{"id", "action"}]}."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None, (jsonify({"error": "Expected a JSON object"}), 400)
+    if 'operations' in data:
+        ops = data['operations']
+        if not isinstance(ops, list) or not all(isinstance(op, dict) for op in ops):
+            return None, (jsonify({"error": "operations must be a list of objects"}), 400)
+        operations = [(op.get('id'), op.get('action')) for op in ops]
+    else:
+        ids = data.get('ids', [])
+        if not isinstance(ids, list):
+            return None, (jsonify({"error": "ids must be a list"}), 400)
+        operations = [(apt_id, data.get('action')) for apt_id in ids]
+    if not operations:
+        return None, (jsonify({"error": "No ids or operations given"}), 400)
+    if len(operations) > MAX_BATCH_SIZE:
+        return None, (jsonify({"error": f"At most {MAX_BATCH_SIZE} items per batch"}), 400)
+    return [(batch_id(i), action) for i, action in operations], None
+
+def batch_id(value):
+    # Only exact ids: ints and digit strings. Anything else (1.9, true, "abc")
+    # stays as sent and comes back as 'invalid_id' rather than being coerced
+    # onto some other row of a destructive batch.
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    return value
+
+def is_batch_id(value):
+    # bool is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+@app.route('/api/appointments/batch', methods=['POST'])
+def batch_appointments():
+    operations, error = read_batch_request()
+    if error:
+        return error
+    results = apply_appointment_batch(operations)
+    on_appointments_changed(results)
+    return jsonify({
+        "status": "success",
+        "applied": sum(1 for r in results if r['status'] == 'ok'),
+        "results": results
+    })
+
 @app.route('/api/queue', methods=['GET'])
+@polled()
 def get_queue_status():
     # Aggregate data from all doctors
-    result = execute_query('SELECT SUM(queue_current) as current, SUM(queue_total) as total FROM users WHERE role = ?', ('doctor',), fetchone=True)
+    result = execute_query(QUEUE_QUERY, ('doctor',), fetchone=True)
     
     # Check result type since SUM can return distinct types or None
     current = result['current'] if result and result.get('current') else 0
@@ -553,16 +1666,37 @@ def get_queue_status():
 @app.route('/api/doctor/status', methods=['POST'])
 def update_doctor_status():
     data = request.json
-    doc_id = data.get('id')
+    user = require_user()
+    if user['role'] != 'doctor':
+        return jsonify({"error": "Only doctors can update their status"}), 403
+    doc_id = user['id']
     
-    if 'status' in data:
-        execute_query('UPDATE users SET status = ? WHERE id = ?', (data['status'], doc_id), commit=True)
-    
-    if 'queue_current' in data:
-        execute_query('UPDATE users SET queue_current = ? WHERE id = ?', (data['queue_current'], doc_id), commit=True)
-        
-    if 'queue_total' in data:
-        execute_query('UPDATE users SET queue_total = ? WHERE id = ?', (data['queue_total'], doc_id), commit=True)
+    # Queue counters feed the auto-assignment load, so only whole numbers >= 0
+    for field in ('queue_current', 'queue_total'):
+        if field in data:
+            try:
+                data[field] = int(data[field])
+            except (TypeError, ValueError):
+                data[field] = -1
+            if data[field] < 0:
+                return jsonify({"error": f"{field} must be a non-negative integer"}), 400
+
+    fields = [f for f in ('status', 'queue_current', 'queue_total') if f in data]
+    if fields:
+        # One transaction with the load bump, so no booking sees the new
+        # status against an old heap
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            for field in fields:
+                cur.execute(f'UPDATE users SET {field} = ? WHERE id = ?', (data[field], doc_id))
+            touch_doctor_departments(cur, [doc_id])
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Cached session copy is now stale
+    invalidate_user(doc_id)
         
     return jsonify({"message": "Status Updated"})
 
@@ -580,33 +1714,116 @@ def save_contact_message():
 
 @app.route('/api/doctor/messages', methods=['GET'])
 def get_messages():
-    msgs = execute_query('SELECT * FROM messages ORDER BY created_at DESC', fetchall=True)
+    query = 'SELECT * FROM messages m ORDER BY created_at DESC'
+    archived = wants_archive()
+    if archived:
+        query = with_archive(query, 'messages', 'm')
+    msgs = execute_query(query, fetchall=True, archive=archived)
     return jsonify(msgs)
 
 # --- ADMIN API ---
 
 @app.route('/api/admin/stats', methods=['GET'])
+@polled()
 def get_admin_stats():
-    # 1. Counts
-    doc_count = execute_query('SELECT count(*) as count FROM users WHERE role = ?', ('doctor',), fetchone=True)['count']
-    patient_count = execute_query('SELECT count(*) as count FROM users WHERE role = ?', ('patient',), fetchone=True)['count']
-    appt_count = execute_query('SELECT count(*) as count FROM appointments', fetchone=True)['count']
-    
-    # 2. Revenue (Mock logic: Assuming $50 per completed appointment)
-    completed_appts = execute_query("SELECT count(*) as count FROM appointments WHERE status = 'Completed'", fetchone=True)['count']
-    revenue = completed_appts * 50
-    
-    # 3. Recent Activity (Last 5 appointments)
-    recent = execute_query("SELECT a.id, a.date, a.status, u.name as patient_name FROM appointments a LEFT JOIN users u ON a.user_mobile = u.mobile ORDER BY a.id DESC LIMIT 5", fetchall=True)
+    # Served from the snapshot kept fresh by the 'stats_rollup' job
+    row = execute_query(SETTING_QUERY, ('admin_stats_snapshot',), fetchone=True)
+    snapshot = json.loads(row['value']) if row else None
+
+    if not snapshot or time.time() - snapshot['generated_at'] > STATS_SNAPSHOT_MAX_AGE:
+        snapshot = compute_admin_stats()
+        snapshot['generated_at'] = time.time()
+        save_setting('admin_stats_snapshot', json.dumps(snapshot, default=to_json))
+
+    return jsonify(snapshot)
+
+@app.route('/api/admin/analytics', methods=['GET'])
+def get_analytics():
+    # Served entirely from appointment_rollups: cost depends on the number of
+    # days/departments/doctors in range, not on appointment history size.
+    group_by = [g.strip() for g in request.args.get('group_by', 'day').split(',') if g.strip()]
+    invalid = [g for g in group_by if g not in ROLLUP_GROUPS]
+    if invalid:
+        return jsonify({"error": f"Invalid group_by: {', '.join(invalid)}. Use any of {', '.join(ROLLUP_GROUPS)}"}), 400
+
+    conditions = []
+    params = []
+    if request.args.get('from'):
+        conditions.append('day >= ?')
+        params.append(rollup_day(request.args['from']))
+    if request.args.get('to'):
+        conditions.append('day <= ?')
+        params.append(rollup_day(request.args['to']))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    sums = ', '.join(f"SUM({c}) as {c}" for c in ROLLUP_COLUMNS)
+    if group_by:
+        groups = ', '.join(group_by)
+        query = f"SELECT {groups}, {sums} FROM appointment_rollups {where} GROUP BY {groups} ORDER BY {groups}"
+    else:
+        query = f"SELECT {sums} FROM appointment_rollups {where}"
+    rows = execute_query(query, tuple(params), fetchall=True)
+    for row in rows:
+        for c in ROLLUP_COLUMNS:
+            row[c] = int(row[c] or 0)
+
+    totals = {c: sum(row[c] for row in rows) for c in ROLLUP_COLUMNS}
+    backfill = execute_query('SELECT value FROM system_settings WHERE key = ?', ('rollup_backfill_cursor',), fetchone=True)
 
     return jsonify({
-        "doctors": doc_count,
-        "patients": patient_count,
-        "appointments": appt_count,
-        "revenue": revenue,
-        "recent_activity": recent
+        "from": request.args.get('from'),
+        "to": request.args.get('to'),
+        "group_by": group_by,
+        "rows": rows,
+        "totals": totals,
+        "backfill_in_progress": backfill is not None
+    })
+
+@app.route('/api/admin/analytics/backfill', methods=['POST'])
+def backfill_analytics():
+    started = start_rollup_backfill()
+    return jsonify({"status": "started" if started else "resumed"})
+
+@app.route('/api/admin/archive', methods=['GET', 'POST'])
+def manage_archive():
+    if request.method == 'POST':
+        # Run a pass now; an interrupted pass resumes from its cursor
+        job_queue.enqueue('archive_batch')
+        return jsonify({"status": "queued"})
+
+    counts = {}
+    for table in ('appointments', 'reports', 'messages'):
+        counts[table] = {
+            "live": execute_query(f'SELECT count(*) as count FROM {table}', fetchone=True)['count'],
+            "archived": execute_query(f'SELECT count(*) as count FROM {archive_table(table)}', fetchone=True, archive=True)['count']
+        }
+    cursor = execute_query('SELECT value FROM system_settings WHERE key = ?', ('archive_cursor',), fetchone=True)
+    return jsonify({
+        "archive_after_days": ARCHIVE_AFTER_DAYS,
+        "cutoff": archive_cutoff(),
+        "tables": counts,
+        "pass_in_progress": json.loads(cursor['value']) if cursor else None
     })
 
+@app.route('/api/admin/throttle', methods=['GET'])
+def get_throttle_counters():
+    # Counters are per process
+    return jsonify({
+        "enabled": RATE_LIMIT_ENABLED,
+        "store": "redis" if RATE_LIMIT_REDIS_URL else "memory",
+        "rate": POLL_RATE,
+        "burst": POLL_BURST,
+        "routes": poll_counters.snapshot()
+    })
+
+@app.route('/api/admin/jobs', methods=['GET'])
+def get_job_dashboard():
+    return jsonify(job_queue.stats())
+
+@app.route('/api/admin/assignment', methods=['GET'])
+def get_assignment_stats():
+    return jsonify(doctor_loads.stats())
+
 @app.route('/api/admin/doctors', methods=['GET', 'POST', 'DELETE'])
 def manage_doctors():
     if request.method == 'GET':
@@ -615,22 +1832,84 @@ def manage_doctors():
     
     if request.method == 'DELETE':
         doc_id = request.args.get('id')
-        execute_query('DELETE FROM users WHERE id = ? AND role = ?', (doc_id, 'doctor'), commit=True)
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            touch_doctor_departments(cur, [doc_id])
+            cur.execute('DELETE FROM users WHERE id = ? AND role = ?', (doc_id, 'doctor'))
+            conn.commit()
+        finally:
+            conn.close()
+        invalidate_user(doc_id)
         return jsonify({"status": "deleted"})
         
     if request.method == 'POST':
         data = request.json
         # Add new doctor
         # Simple password generation (mobile as password for now)
+        conn = get_db_connection()
         try:
-            execute_query(
+            cur = conn.cursor()
+            cur.execute(
                 "INSERT INTO users (name, age, mobile, role, department, status, queue_current, queue_total, room_number, description) VALUES (?, ?, ?, 'doctor', ?, 'Available', 0, 0, ?, ?)",
-                (data['name'], 45, data['mobile'], data['department'], data['room'], data['description']),
-                commit=True
+                (data['name'], 45, data['mobile'], data['department'], data['room'], data['description'])
             )
+            touch_departments(cur, [data['department']])
+            conn.commit()
             return jsonify({"status": "success"})
         except Exception as e:
+            conn.rollback()
             return jsonify({"error": str(e)}), 400
+        finally:
+            conn.close()
+
+def delete_users_batch(role):
+    operations, error = read_batch_request()
+    if error:
+        return error
+    ids = sorted({i for i, action in operations if action == 'delete' and is_batch_id(i)})
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        existing = set()
+        if ids:
+            id_list = ', '.join(['?'] * len(ids))
+            cur.execute(f"SELECT id FROM users WHERE role = ? AND id IN ({id_list})", [role] + ids)
+            existing = {r['id'] for r in cur.fetchall()}
+            if role == 'doctor' and existing:
+                touch_doctor_departments(cur, existing)
+            cur.execute(f"DELETE FROM users WHERE role = ? AND id IN ({id_list})", [role] + ids)
+        conn.commit()
+    finally:
+        conn.close()
+
+    results = []
+    for user_id, action in operations:
+        if not is_batch_id(user_id):
+            status = 'invalid_id'
+        elif action != 'delete':
+            status = 'invalid_action'
+        elif user_id in existing:
+            status = 'ok'
+            existing.discard(user_id)
+            invalidate_user(user_id)
+        else:
+            status = 'not_found'
+        results.append({"id": user_id, "action": action, "status": status})
+    return jsonify({
+        "status": "success",
+        "applied": sum(1 for r in results if r['status'] == 'ok'),
+        "results": results
+    })
+
+@app.route('/api/admin/doctors/batch', methods=['POST'])
+def batch_doctors():
+    return delete_users_batch('doctor')
+
+@app.route('/api/admin/patients/batch', methods=['POST'])
+def batch_patients():
+    return delete_users_batch('patient')
 
 @app.route('/api/admin/patients', methods=['GET', 'DELETE'])
 def manage_patients():
@@ -641,6 +1920,7 @@ def manage_patients():
     if request.method == 'DELETE':
         patient_id = request.args.get('id')
         execute_query('DELETE FROM users WHERE id = ? AND role = ?', (patient_id, 'patient'), commit=True)
+        invalidate_user(patient_id)
         return jsonify({"status": "deleted"})
 
 @app.route('/api/admin/all_appointments', methods=['GET'])
@@ -656,7 +1936,12 @@ def get_admin_appointments():
     return jsonify(appointments)
 
 # Run DB Init on Import (for Gunicorn/Render)
-init_db_if_needed()
+job_queue.create_table()
+if not MULTI_TENANT:
+    init_db_if_needed()
+
+if JOB_WORKER_MODE == 'thread':
+    job_queue.start_thread()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,428 @@
+import os
+import re
+import sqlite3
+import threading
+
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+# Data-access layer: one Backend per database engine.
+#
+# Application SQL is written once with `?` placeholders. Each backend compiles
+# a statement to its own dialect the first time it is seen and keeps the
+# result, so dispatch is a dict lookup instead of string rewriting per call.
+# Rows come back as `Row` objects (one shared column index per result set plus
+# a tuple of values) whatever the engine.
+#
+# Connections are reused: SQLite keeps one connection per thread (so its own
+# prepared-statement cache survives across requests), Postgres uses a thread
+# safe pool and the in-memory backend shares a single locked connection.
+# Calling close() on a connection hands it back rather than closing it.
+# Backend.close() drops the backend's own connections once none are in use.
+#
+# Adding an engine means subclassing Backend and filling in the dialect hooks.
+
+POSTGRES_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+POOL_TIMEOUT = 30  # seconds to wait for a free pooled connection
+
+
+class Row:
+    """Read-mostly result row supporting row['col'], row[0], row.get() and dict(row)."""
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._values[key]
+        return self._values[self._index[key]]
+
+    def __setitem__(self, key, value):
+        values = list(self._values)
+        values[self._index[key]] = value
+        self._values = tuple(values)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._index, self._values)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self.as_dict() == other.as_dict()
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def as_dict(self):
+        return dict(zip(self._index, self._values))
+
+    def __repr__(self):
+        return f"Row({self.as_dict()!r})"
+
+
+def to_json(obj):
+    """`default=` hook for json.dumps so Row objects serialise like dicts."""
+    if isinstance(obj, Row):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+_index_cache = {}
+
+def _row_index(description):
+    columns = tuple(d[0] for d in description)
+    index = _index_cache.get(columns)
+    if index is None:
+        index = _index_cache[columns] = {name: i for i, name in enumerate(columns)}
+    return index
+
+
+class Cursor:
+    __slots__ = ('_cur', '_compile')
+
+    def __init__(self, cur, compile):
+        self._cur = cur
+        self._compile = compile
+
+    def execute(self, query, params=()):
+        self._cur.execute(self._compile(query), params)
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self._cur.executemany(self._compile(query), seq_of_params)
+        return self
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        return None if row is None else Row(_row_index(self._cur.description), row)
+
+    def fetchall(self):
+        rows = self._cur.fetchall()
+        if not rows:
+            return []
+        index = _row_index(self._cur.description)
+        return [Row(index, row) for row in rows]
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+
+class Connection:
+    __slots__ = ('raw', 'backend', '_released')
+
+    def __init__(self, raw, backend):
+        self.raw = raw
+        self.backend = backend
+        self._released = False
+
+    def cursor(self):
+        return Cursor(self.raw.cursor(), self.backend.compile)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        # Returns the connection to its backend; safe to call twice
+        if not self._released:
+            self._released = True
+            self.backend.release(self.raw)
+
+
+class BackendClosed(Exception):
+    pass
+
+
+class Backend:
+    name = None
+    postgres = False
+    for_update = ''          # appended to SELECTs that lock rows
+    for_update_skip = ''     # same, but skipping rows other transactions hold
+    supports_partitions = False
+    Error = Exception        # raised by the driver, e.g. for a missing table
+    # DDL fragments substituted into the shared schema templates
+    types = {}
+
+    def __init__(self, statements=None):
+        # Backends of the same engine may share one compiled-statement cache
+        self.statements = {} if statements is None else statements
+        self.leases = 0  # connections handed out and not yet released
+        self.closed = False
+        self._lease_lock = threading.Lock()
+
+    # --- statements ---
+
+    def compile(self, query):
+        compiled = self.statements.get(query)
+        if compiled is None:
+            compiled = self.statements[query] = self._translate(query)
+        return compiled
+
+    def prepare(self, queries):
+        """Compiles known statements up front (done once at startup)."""
+        for query in queries:
+            self.compile(query)
+
+    def _translate(self, query):
+        return query
+
+    def ddl(self, template):
+        return template.format(**self.types)
+
+    # --- connections ---
+
+    def connect(self, archive=False):
+        with self._lease_lock:
+            if self.closed:
+                raise BackendClosed(f"{self.name} backend is closed")
+            self.leases += 1
+        try:
+            return Connection(self._open(archive), self)
+        except Exception:
+            self.release(None)
+            raise
+
+    def release(self, raw):
+        try:
+            if raw is not None:
+                self._release(raw)
+        finally:
+            with self._lease_lock:
+                self.leases -= 1
+                done = self.closed and self.leases == 0
+            if done:
+                self._close()
+
+    def close(self):
+        """Stops handing out connections; the pool itself is closed as soon
+        as every connection in use has been released."""
+        with self._lease_lock:
+            if self.closed:
+                return
+            self.closed = True
+            idle = self.leases == 0
+        if idle:
+            self._close()
+
+    def _open(self, archive):
+        raise NotImplementedError
+
+    def _release(self, raw):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    # --- dialect hooks ---
+
+    def begin_write(self, cur):
+        """Starts a transaction that holds the write lock until commit."""
+
+    def archive_table(self, name):
+        raise NotImplementedError
+
+    def table_columns(self, cur, table):
+        raise NotImplementedError
+
+
+class SQLiteBackend(Backend):
+    name = 'SQLite'
+    Error = sqlite3.Error
+    types = {'pk': 'INTEGER PRIMARY KEY AUTOINCREMENT', 'timestamp': 'TEXT', 'float': 'REAL'}
+
+    def __init__(self, path, archive_path, statements=None):
+        super().__init__(statements)
+        self.path = path
+        self.archive_path = archive_path
+        self.local = threading.local()
+
+    def _open(self, archive):
+        raw = getattr(self.local, 'conn', None)
+        if raw is None:
+            raw = self.local.conn = sqlite3.connect(self.path, timeout=30)
+            self.local.attached = False
+            self.local.depth = 0
+        if archive and not self.local.attached:
+            # Archive lives in its own file, attached the first time it is needed
+            raw.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            self.local.attached = True
+        self.local.depth += 1
+        return raw
+
+    def _release(self, raw):
+        # Nested users share the thread's connection; only the outermost
+        # release may discard a transaction that was left open
+        self.local.depth -= 1
+        if self.local.depth == 0 and raw.in_transaction:
+            raw.rollback()
+
+    def _close(self):
+        # Other threads' connections are closed when their thread-local
+        # storage is garbage collected
+        raw = getattr(self.local, 'conn', None)
+        if raw is not None and self.local.depth == 0:
+            raw.close()
+        self.local = threading.local()
+
+    def begin_write(self, cur):
+        cur.execute('BEGIN IMMEDIATE')
+
+    def archive_table(self, name):
+        return f"archive.{name}"
+
+    def table_columns(self, cur, table):
+        cur.execute(f"PRAGMA table_info({table})")
+        return [row['name'] for row in cur.fetchall()]
+
+
+class MemoryBackend(SQLiteBackend):
+    # One shared in-memory database for tests and benchmarks. All threads use
+    # the same connection, serialised by a lock held from connect() to close().
+    name = 'Memory'
+
+    def __init__(self, statements=None):
+        super().__init__(':memory:', ':memory:', statements)
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.raw = sqlite3.connect(':memory:', check_same_thread=False)
+        self.raw.execute("ATTACH DATABASE ':memory:' AS archive")
+
+    def _open(self, archive):
+        self.lock.acquire()
+        self.depth += 1
+        return self.raw
+
+    def _release(self, raw):
+        try:
+            self.depth -= 1
+            if self.depth == 0 and raw.in_transaction:
+                raw.rollback()
+        finally:
+            self.lock.release()
+
+    def _close(self):
+        self.raw.close()
+
+
+_QMARK = re.compile(r"'(?:[^']|'')*'|\?|%")
+
+def _to_format_style(match):
+    token = match.group(0)
+    if token == '?':
+        return '%s'
+    # psycopg2 treats every % as a format character once params are passed
+    return token.replace('%', '%%')
+
+
+class PostgresBackend(Backend):
+    name = 'PostgreSQL'
+    postgres = True
+    for_update = ' FOR UPDATE'
+    for_update_skip = ' FOR UPDATE SKIP LOCKED'
+    supports_partitions = True
+    types = {'pk': 'SERIAL PRIMARY KEY', 'timestamp': 'TIMESTAMP', 'float': 'DOUBLE PRECISION'}
+
+    def __init__(self, url, pool_size=POSTGRES_POOL_SIZE, schema=None, statements=None, min_idle=1):
+        super().__init__(statements)
+        if psycopg2 is None:
+            raise RuntimeError("DATABASE_URL is set but psycopg2 is not installed")
+        self.Error = psycopg2.Error
+        self.schema = schema
+        # psycopg2's pool raises once every connection is out; callers past
+        # pool_size wait here for a slot instead
+        self.slots = threading.BoundedSemaphore(pool_size)
+        # min_idle connections stay open between requests and psycopg2 closes
+        # the rest on return; per-tenant pools use 0 so idle tenants hold none
+        if schema:
+            if not re.match(r'^[A-Za-z0-9_-]{1,63}$', schema):
+                raise ValueError(f"Invalid schema name '{schema}'")
+            # Every pooled connection resolves unqualified tables in the schema
+            self.pool = psycopg2.pool.ThreadedConnectionPool(min_idle, pool_size, url, options=f'-c search_path="{schema}"')
+            raw = self.pool.getconn()
+            try:
+                raw.cursor().execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+                raw.commit()
+            finally:
+                self.pool.putconn(raw)
+        else:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(min_idle, pool_size, url)
+
+    def _translate(self, query):
+        return _QMARK.sub(_to_format_style, query)
+
+    def _open(self, archive):
+        if not self.slots.acquire(timeout=POOL_TIMEOUT):
+            raise psycopg2.pool.PoolError(f"No database connection free after {POOL_TIMEOUT}s")
+        try:
+            # Archive tables live in the same database on Postgres
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _release(self, raw):
+        try:
+            if raw.closed:
+                self.pool.putconn(raw, close=True)
+                return
+            if raw.status != psycopg2.extensions.STATUS_READY:
+                raw.rollback()
+            self.pool.putconn(raw)
+        finally:
+            self.slots.release()
+
+    def _close(self):
+        self.pool.closeall()
+
+    def archive_table(self, name):
+        return f"{name}_archive"
+
+    def table_columns(self, cur, table):
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = ?", (table,))
+        return [row['column_name'] for row in cur.fetchall()]
+
+
+def create_backend(database_url=None, db_file=None, archive_file=None, kind=None,
+                   schema=None, pool_size=POSTGRES_POOL_SIZE, statements=None, min_idle=1):
+    """Picks the backend: STORAGE_BACKEND=memory|sqlite|postgres, else Postgres
+    when DATABASE_URL is set and SQLite otherwise. `schema` and `min_idle`
+    (Postgres only) scope every connection to that schema and set how many
+    connections are kept open while idle."""
+    kind = kind or ('postgres' if database_url else 'sqlite')
+    if kind == 'memory':
+        return MemoryBackend(statements)
+    if kind == 'postgres':
+        return PostgresBackend(database_url, pool_size, schema, statements, min_idle)
+    if kind == 'sqlite':
+        return SQLiteBackend(db_file, archive_file, statements)
+    raise ValueError(f"Unknown storage backend '{kind}'")
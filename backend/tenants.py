@@ -0,0 +1,151 @@
+import contextvars
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Multi-tenant mode: one deployment serving many clinics.
+#
+# The active tenant lives in a context variable, set per request (from the
+# Host or a header) and restored by the job queue around each job. Every
+# tenant has its own backend (its own SQLite file, or its own Postgres schema
+# with a small pool). TenantRouter stands in for a single Backend: dialect
+# attributes come from a base backend, connect() goes to the current tenant's.
+# Backends are opened on first use and the least recently used idle ones are
+# closed once too many are open or they have sat idle for too long.
+
+# At most 56 characters: the Postgres schema is 'tenant_<id>' and identifiers
+# are cut off at 63, which would let two long ids share a schema
+TENANT_ID = re.compile(r'^[a-z0-9][a-z0-9_-]{0,55}$')
+DEFAULT_MAX_OPEN = 100  # tenant backends kept open per process
+DEFAULT_IDLE_TIMEOUT = 600  # seconds before an unused tenant backend is closed
+
+tenant_var = contextvars.ContextVar('tenant', default=None)
+
+
+class UnknownTenant(Exception):
+    pass
+
+
+def current_tenant():
+    return tenant_var.get()
+
+
+@contextmanager
+def use_tenant(tenant):
+    token = tenant_var.set(tenant)
+    try:
+        yield
+    finally:
+        tenant_var.reset(token)
+
+
+def valid_tenant(tenant):
+    return bool(tenant) and TENANT_ID.match(tenant) is not None
+
+
+class TenantRouter:
+    def __init__(self, base, factory, setup=None, max_open=DEFAULT_MAX_OPEN, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.base = base  # supplies the dialect and the compiled-statement cache
+        self.factory = factory  # tenant -> Backend
+        self.setup = setup  # tenant -> None, run until it first succeeds for a tenant (schema setup)
+        self.set_up = set()
+        self.setting_up = {}  # tenant -> thread running its setup
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.backends = OrderedDict()  # tenant -> (backend, last_used), least recent first
+        # The router lock only guards the bookkeeping above. Opening and
+        # setting up a tenant happens under that tenant's own lock, so a slow
+        # first request for one clinic never holds up the others.
+        self.lock = threading.Lock()
+        self.tenant_locks = {}
+        self.pinned = {}  # tenant -> connects in progress, never evicted meanwhile
+        self.opened = 0
+        self.evicted = 0
+
+    def __getattr__(self, name):
+        # Dialect attributes and hooks (for_update, ddl, archive_table, ...)
+        return getattr(self.base, name)
+
+    def _ready(self, tenant):
+        # Setup connects through the router itself; its own thread may go ahead
+        return (self.setup is None or tenant in self.set_up
+                or self.setting_up.get(tenant) == threading.get_ident())
+
+    def connect(self, archive=False):
+        tenant = tenant_var.get()
+        if tenant is None:
+            raise UnknownTenant("No tenant selected")
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                entry = self.backends.get(tenant)
+                if entry is not None and self._ready(tenant):
+                    backend = entry[0]
+                    self.backends[tenant] = (backend, now)
+                    self.backends.move_to_end(tenant)
+                    self._evict(now, keep=tenant)
+                    self.pinned[tenant] = self.pinned.get(tenant, 0) + 1
+                    break
+                tenant_lock = self.tenant_locks.setdefault(tenant, threading.Lock())
+            with tenant_lock:
+                self._open(tenant)
+
+        # Pinned, so eviction cannot close the backend before the connection
+        # is leased; connecting may wait for a pooled connection, so it
+        # happens outside the router lock
+        try:
+            return backend.connect(archive=archive)
+        finally:
+            with self.lock:
+                self.pinned[tenant] -= 1
+                if not self.pinned[tenant]:
+                    del self.pinned[tenant]
+
+    def _open(self, tenant):
+        # Under the tenant's lock: a thread that waited here finds the work done
+        with self.lock:
+            entry = self.backends.get(tenant)
+            if entry is not None and self._ready(tenant):
+                return
+            needs_setup = self.setup is not None and tenant not in self.set_up
+            if needs_setup:
+                self.setting_up[tenant] = threading.get_ident()
+        try:
+            if entry is None:
+                backend = self.factory(tenant)
+                with self.lock:
+                    self.backends[tenant] = (backend, time.monotonic())
+                    self.opened += 1
+            if needs_setup:
+                # Marked only on success; a failed setup is retried by the
+                # tenant's next request
+                self.setup(tenant)
+                with self.lock:
+                    self.set_up.add(tenant)
+        finally:
+            if needs_setup:
+                with self.lock:
+                    del self.setting_up[tenant]
+
+    def _evict(self, now, keep):
+        for tenant, (backend, last_used) in list(self.backends.items()):
+            if len(self.backends) <= self.max_open and now - last_used < self.idle_timeout:
+                break
+            if tenant == keep or backend.leases or tenant in self.pinned or tenant in self.setting_up:
+                continue
+            del self.backends[tenant]
+            backend.close()
+            self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "open": len(self.backends),
+                "in_use": sum(1 for backend, _ in self.backends.values() if backend.leases),
+                "max_open": self.max_open,
+                "idle_timeout": self.idle_timeout,
+                "opened": self.opened,
+                "evicted": self.evicted
+            }
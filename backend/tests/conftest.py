@@ -0,0 +1,41 @@
+import os
+import sys
+
+# The suite runs the app on a throwaway in-memory database:
+#   cd backend && python -m pytest -q
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ['JOB_WORKER_MODE'] = 'external'
+os.environ['RATE_LIMIT_ENABLED'] = '0'
+os.environ.setdefault('SECRET_KEY', 'test-secret')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def server():
+    import server as app_module
+    return app_module
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def run_jobs(server):
+    def run():
+        while server.job_queue.run_one():
+            pass
+    run()
+    return run
+
+
+@pytest.fixture
+def patient(client):
+    """Logs a patient in by mobile; returns their Authorization header."""
+    def login(mobile):
+        token = client.post('/api/login', json={'mobile': mobile, 'name': 'Test Patient', 'age': 30}).get_json()['token']
+        return {'Authorization': f"Bearer {token}"}
+    return login
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+
+def archive_cursor(server):
+    row = server.execute_query('SELECT value FROM system_settings WHERE key = ?', ('archive_cursor',), fetchone=True)
+    return json.loads(row['value']) if row else None
+
+
+def archived_ids(server, dept):
+    rows = server.execute_query(
+        f"SELECT id FROM {server.archive_table('appointments')} WHERE dept = ? ORDER BY id",
+        (dept,), fetchall=True, archive=True
+    )
+    return [row['id'] for row in rows]
+
+
+@pytest.fixture
+def old_visits(server, client, patient, run_jobs):
+    # Closed appointments well past the archive horizon, each with a report,
+    # plus one recent and one still open that must stay live
+    dept = 'Archive Resume'
+    headers = patient('9000000003')
+    old = []
+    for day in range(1, 8):
+        apt_id = client.post('/api/book', json={'dept': dept, 'date': f'2020-03-{day:02d}'}, headers=headers).get_json()['id']
+        client.post('/api/doctor/report', json={'appointment_id': apt_id, 'diagnosis': 'd', 'medicines': 'm', 'notes': 'n'})
+        old.append(apt_id)
+    recent = client.post('/api/book', json={'dept': dept}, headers=headers).get_json()['id']
+    server.apply_appointment_change(recent, 'Cancelled')
+    still_open = client.post('/api/book', json={'dept': dept, 'date': '2020-03-09'}, headers=headers).get_json()['id']
+    run_jobs()
+    # Start the pass just before these rows, whatever other tests left behind
+    server.execute_query(
+        "INSERT INTO system_settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+        ('archive_cursor', json.dumps({"stage": "appointments", "last_id": old[0] - 1})), commit=True
+    )
+    return dept, headers, old, [recent, still_open]
+
+
+def test_interrupted_pass_resumes_from_cursor(server, client, monkeypatch, old_visits):
+    dept, headers, old, live = old_visits
+
+    assert server.archive_batch(batch_size=2) is False
+    first = archive_cursor(server)
+    assert first == {"stage": "appointments", "last_id": old[1]}
+    moved = archived_ids(server, dept)
+    assert moved == old[:2]
+
+    # A batch that fails half way (appointments copied, reports not yet)
+    # rolls back its moves and its cursor
+    real_archive_table = server.archive_table
+
+    def failing_archive_table(name):
+        if name == 'reports':
+            raise RuntimeError('interrupted')
+        return real_archive_table(name)
+
+    monkeypatch.setattr(server, 'archive_table', failing_archive_table)
+    with pytest.raises(RuntimeError):
+        server.archive_batch(batch_size=2)
+    monkeypatch.setattr(server, 'archive_table', real_archive_table)
+    assert archive_cursor(server) == first
+    assert archived_ids(server, dept) == moved
+
+    while not server.archive_batch(batch_size=2):
+        pass
+    assert archive_cursor(server) is None
+
+    # Every old closed visit moved exactly once, with its report
+    assert archived_ids(server, dept) == old
+    rows = server.execute_query('SELECT id FROM appointments WHERE dept = ? ORDER BY id', (dept,), fetchall=True)
+    assert [row['id'] for row in rows] == live
+    reports = server.execute_query(
+        f"SELECT appointment_id FROM {server.archive_table('reports')} ORDER BY appointment_id", fetchall=True, archive=True
+    )
+    assert set(old) <= {row['appointment_id'] for row in reports}
+
+    # The patient still sees their whole history
+    listed = client.get('/api/appointments', headers=headers).get_json()
+    assert sorted(apt['id'] for apt in listed) == sorted(old + live)
@@ -0,0 +1,95 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from export import ZipStream, bytes_entry, file_entry
+
+
+@pytest.fixture
+def stream(tmp_path):
+    upload = tmp_path / 'scan.bin'
+    upload.write_bytes(os.urandom(150 * 1024))
+    entries = [
+        bytes_entry('patient.json', b'{"name": "Test"}'),
+        file_entry('uploads/scan.bin', str(upload)),
+        bytes_entry('reports/1.html', b'<html>report</html>')
+    ]
+    stream = ZipStream(entries)
+    yield stream
+    stream.close()
+
+
+def read_all(stream):
+    stream.seek(0)
+    return stream.read()
+
+
+def read_range(stream, start, length):
+    # A raw stream may return short reads at part boundaries
+    stream.seek(start)
+    data = b''
+    while len(data) < length:
+        chunk = stream.read(length - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_archive_is_a_valid_zip(stream, tmp_path):
+    data = read_all(stream)
+    assert len(data) == stream.size
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.read('patient.json') == b'{"name": "Test"}'
+        assert archive.read('uploads/scan.bin') == (tmp_path / 'scan.bin').read_bytes()
+
+
+def test_range_reads_match_full_download(stream):
+    data = read_all(stream)
+    upload_start = next(start for start, length, _, path in stream.parts if path)
+    # Ranges inside one part, across part boundaries and at the very end
+    for start, length in [(0, 10), (5, upload_start), (upload_start - 3, 100), (1000, 64 * 1024),
+                          (stream.size - 50, 50), (stream.size - 1, 10)]:
+        assert read_range(stream, start, length) == data[start:start + length]
+
+
+def test_seek_from_end_and_past_the_end(stream):
+    data = read_all(stream)
+    stream.seek(-22, io.SEEK_END)
+    assert stream.read() == data[-22:]
+    assert stream.tell() == stream.size
+    stream.seek(stream.size + 5)
+    assert stream.read(10) == b''
+
+
+def test_changed_file_fails_the_download(stream, tmp_path):
+    (tmp_path / 'scan.bin').write_bytes(b'short')
+    with pytest.raises(OSError):
+        read_all(stream)
+
+
+def test_export_link_serves_ranges(client, patient):
+    headers = patient('9000000004')
+    client.post('/api/book', json={'dept': 'Export Range'}, headers=headers)
+    url = client.post('/api/patients/9000000004/export', headers=headers).get_json()['url']
+
+    full = client.get(url)
+    assert full.status_code == 200
+    data = full.data
+
+    partial = client.get(url, headers={'Range': 'bytes=100-199'})
+    assert partial.status_code == 206
+    assert partial.data == data[100:200]
+    assert partial.headers['Content-Range'] == f'bytes 100-199/{len(data)}'
+
+    # Resuming with the current ETag continues; a stale one restarts
+    etag = full.headers['ETag']
+    resumed = client.get(url, headers={'Range': f'bytes={len(data) - 10}-', 'If-Range': etag})
+    assert resumed.status_code == 206 and resumed.data == data[-10:]
+    stale = client.get(url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert stale.status_code == 200 and stale.data == data
+
+    assert client.get(url, headers={'Range': f'bytes={len(data) + 10}-'}).status_code == 416
@@ -0,0 +1,60 @@
+import time
+
+from jobs import JobQueue
+from storage import MemoryBackend
+
+
+class CountingBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.write_locks = 0
+
+    def begin_write(self, cur):
+        self.write_locks += 1
+        super().begin_write(cur)
+
+
+def make_queue():
+    db = CountingBackend()
+    queue = JobQueue(db)
+    queue.create_table()
+    return db, queue
+
+
+def test_idle_poll_takes_no_write_lock():
+    db, queue = make_queue()
+    ran = []
+    queue.handler('ping')(ran.append)
+
+    assert queue.run_one() is False
+    queue.enqueue('ping', {"n": 1}, delay=60)
+    assert queue.run_one() is False
+    assert db.write_locks == 0
+
+    queue.enqueue('ping', {"n": 2})
+    assert queue.run_one() is True
+    assert ran == [{"n": 2}] and db.write_locks == 1
+
+
+def test_purge_removes_old_done_and_failed_jobs():
+    db, queue = make_queue()
+    for kind in ('old_done', 'old_failed', 'new_failed', 'waiting'):
+        queue.enqueue(kind)
+    now = time.time()
+    conn = db.connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE kind = 'old_done'", (now - 100,))
+        cur.execute("UPDATE jobs SET status = 'failed', finished_at = ? WHERE kind = 'old_failed'", (now - 100,))
+        cur.execute("UPDATE jobs SET status = 'failed', finished_at = ? WHERE kind = 'new_failed'", (now - 10,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    queue.purge(older_than=50, failed_older_than=50)
+    conn = db.connect()
+    try:
+        kinds = [row['kind'] for row in conn.cursor().execute('SELECT kind FROM jobs ORDER BY kind').fetchall()]
+    finally:
+        conn.close()
+    assert kinds == ['new_failed', 'waiting']
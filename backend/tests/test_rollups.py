@@ -0,0 +1,79 @@
+import threading
+
+COUNTS = ['booked', 'confirmed', 'cancelled', 'completed', 'no_show']
+
+
+def book(client, headers, dept, n):
+    return [client.post('/api/book', json={'dept': dept}, headers=headers).get_json()['id'] for _ in range(n)]
+
+
+def backfill_cursor(server):
+    row = server.execute_query('SELECT value FROM system_settings WHERE key = ?', ('rollup_backfill_cursor',), fetchone=True)
+    return int(row['value']) if row else None
+
+
+def rollup_totals(server, dept):
+    row = server.execute_query(
+        f"SELECT {', '.join(f'COALESCE(SUM({c}), 0) as {c}' for c in COUNTS)} FROM appointment_rollups WHERE dept = ?",
+        (dept,), fetchone=True
+    )
+    return row.as_dict()
+
+
+def recount(server, dept):
+    rows = server.execute_query('SELECT status FROM appointments WHERE dept = ?', (dept,), fetchall=True)
+    counts = dict.fromkeys(COUNTS, 0)
+    counts['booked'] = len(rows)
+    for row in rows:
+        column = server.ROLLUP_STATUS_COLUMNS.get(row['status'])
+        if column:
+            counts[column] += 1
+    return counts
+
+
+def test_transitions_keep_rollups_in_step(server, client, patient, run_jobs):
+    dept = 'Rollup Steady'
+    ids = book(client, patient('9000000001'), dept, 4)
+    server.apply_appointment_change(ids[0], 'Confirmed')
+    server.apply_appointment_change(ids[1], 'Completed')
+    server.apply_appointment_change(ids[1], 'Cancelled')
+    server.apply_appointment_change(ids[2], delete=True)
+    run_jobs()
+    assert rollup_totals(server, dept) == recount(server, dept)
+
+
+def test_deltas_during_backfill_count_once(server, client, patient, run_jobs):
+    dept = 'Rollup Backfill'
+    headers = patient('9000000002')
+    ids = book(client, headers, dept, 6)
+
+    assert server.start_rollup_backfill()
+    # Fold rows one at a time until the cursor sits inside this department's
+    # appointments: the first half is counted, the rest is not yet
+    while backfill_cursor(server) < ids[2]:
+        server.run_rollup_backfill({'batch_size': 1})
+    assert backfill_cursor(server) == ids[2]
+
+    # Behind the cursor: applied as deltas. Past it: left to the backfill.
+    server.apply_appointment_change(ids[0], 'Confirmed')
+    server.apply_appointment_change(ids[1], delete=True)
+    server.apply_appointment_change(ids[4], 'Cancelled')
+    server.apply_appointment_change(ids[5], 'Completed')
+    ids += book(client, headers, dept, 1)
+
+    run_jobs()
+    assert backfill_cursor(server) is None
+    assert rollup_totals(server, dept) == recount(server, dept)
+
+
+def test_concurrent_backfill_starts_once(server, run_jobs):
+    started = []
+    threads = [threading.Thread(target=lambda: started.append(server.start_rollup_backfill())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(started) == [False] * 7 + [True]
+
+    run_jobs()
+    assert backfill_cursor(server) is None
@@ -0,0 +1,65 @@
+import json
+
+from storage import MemoryBackend, Row, _QMARK, _to_format_style, to_json
+
+
+def to_postgres(query):
+    return _QMARK.sub(_to_format_style, query)
+
+
+def test_row_access():
+    row = Row({'id': 0, 'name': 1}, (7, 'Asha'))
+    assert row['id'] == 7 and row[1] == 'Asha'
+    assert row.get('name') == 'Asha' and row.get('missing', 'x') == 'x'
+    assert 'name' in row and 'missing' not in row
+    assert list(row) == ['id', 'name'] and len(row) == 2
+    assert dict(row) == {'id': 7, 'name': 'Asha'}
+    assert row == {'id': 7, 'name': 'Asha'}
+    assert row.values() == [7, 'Asha']
+
+
+def test_row_assignment_and_json():
+    row = Row({'id': 0, 'status': 1}, (1, 'Scheduled'))
+    row['status'] = 'Completed'
+    assert row.as_dict() == {'id': 1, 'status': 'Completed'}
+    assert json.loads(json.dumps([row], default=to_json)) == [{'id': 1, 'status': 'Completed'}]
+
+
+def test_rows_from_backend_share_one_index():
+    backend = MemoryBackend()
+    conn = backend.connect()
+    try:
+        cur = conn.cursor()
+        cur.execute('CREATE TABLE t (id INTEGER, name TEXT)')
+        cur.executemany('INSERT INTO t VALUES (?, ?)', [(1, 'a'), (2, 'b')])
+        rows = cur.execute('SELECT id, name FROM t ORDER BY id').fetchall()
+        assert [r.as_dict() for r in rows] == [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+        assert rows[0]._index is rows[1]._index
+        assert cur.execute('SELECT id FROM t WHERE id = ?', (3,)).fetchone() is None
+    finally:
+        conn.close()
+        backend.close()
+
+
+def test_placeholders_become_format_style():
+    assert to_postgres('SELECT * FROM users WHERE id = ? AND role = ?') == 'SELECT * FROM users WHERE id = %s AND role = %s'
+
+
+def test_percent_is_escaped():
+    assert to_postgres("SELECT * FROM users WHERE name LIKE 'Dr%' AND id = ?") == "SELECT * FROM users WHERE name LIKE 'Dr%%' AND id = %s"
+    assert to_postgres('SELECT id % 2 FROM t') == 'SELECT id %% 2 FROM t'
+
+
+def test_quoted_question_marks_are_kept():
+    assert to_postgres("SELECT '?' AS q, ? AS p") == "SELECT '?' AS q, %s AS p"
+    # Doubled quotes stay inside the literal
+    assert to_postgres("SELECT 'it''s ?' FROM t WHERE id = ?") == "SELECT 'it''s ?' FROM t WHERE id = %s"
+
+
+def test_compiled_statements_are_cached():
+    backend = MemoryBackend()
+    query = 'SELECT ?'
+    assert query not in backend.statements
+    assert backend.compile(query) == query
+    assert query in backend.statements
+    backend.close()
@@ -0,0 +1,106 @@
+import pytest
+
+from tenants import TenantRouter, UnknownTenant, use_tenant
+
+
+class FakeConnection:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def close(self):
+        self.backend.leases -= 1
+
+
+class FakeBackend:
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.leases = 0
+        self.closed = False
+
+    def connect(self, archive=False):
+        assert not self.closed
+        self.leases += 1
+        return FakeConnection(self)
+
+    def close(self):
+        self.closed = True
+
+
+def make_router(**kwargs):
+    opened = {}
+
+    def factory(tenant):
+        backend = opened[tenant] = FakeBackend(tenant)
+        return backend
+
+    return TenantRouter(FakeBackend('base'), factory, **kwargs), opened
+
+
+def touch(router, tenant):
+    with use_tenant(tenant):
+        router.connect().close()
+
+
+def test_least_recently_used_tenant_is_closed():
+    router, opened = make_router(max_open=2)
+    touch(router, 'alpha')
+    touch(router, 'beta')
+    touch(router, 'alpha')
+    touch(router, 'gamma')
+    assert list(router.backends) == ['alpha', 'gamma']
+    assert opened['beta'].closed and not opened['alpha'].closed
+    assert router.stats()['evicted'] == 1
+
+    # Reopened on its next request
+    touch(router, 'beta')
+    assert not router.backends['beta'][0].closed
+    assert router.stats()['opened'] == 4
+
+
+def test_tenant_in_use_is_not_closed():
+    router, opened = make_router(max_open=1)
+    with use_tenant('alpha'):
+        conn = router.connect()
+    touch(router, 'beta')
+    touch(router, 'gamma')
+    assert not opened['alpha'].closed
+    assert opened['beta'].closed
+
+    conn.close()
+    touch(router, 'delta')
+    assert opened['alpha'].closed
+
+
+def test_idle_tenants_are_closed():
+    router, opened = make_router(idle_timeout=60)
+    touch(router, 'alpha')
+    touch(router, 'beta')
+    backend, last_used = router.backends['alpha']
+    router.backends['alpha'] = (backend, last_used - 61)
+    touch(router, 'beta')
+    assert opened['alpha'].closed and list(router.backends) == ['beta']
+
+
+def test_failed_setup_is_retried():
+    attempts = []
+
+    def setup(tenant):
+        attempts.append(tenant)
+        if len(attempts) == 1:
+            raise RuntimeError('migration failed')
+
+    router, opened = make_router(setup=setup)
+    with pytest.raises(RuntimeError):
+        touch(router, 'alpha')
+    assert 'alpha' not in router.set_up
+
+    touch(router, 'alpha')
+    touch(router, 'alpha')
+    assert attempts == ['alpha', 'alpha'] and 'alpha' in router.set_up
+    assert router.stats()['opened'] == 1
+
+
+def test_no_tenant_selected():
+    router, opened = make_router()
+    with pytest.raises(UnknownTenant):
+        router.connect()
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Protection for the endpoints browsers poll on timers.
+#
+# TokenBucketLimiter: per (client, route) token bucket. Each request spends a
+# token; tokens refill at `rate` per second up to `burst`. The in-memory store
+# is per process; RedisTokenBucketLimiter keeps buckets in Redis so every
+# gunicorn worker and host shares the same budget.
+#
+# SingleFlight: concurrent identical GETs wait for the one request already in
+# flight and reuse its result instead of each running the same DB query.
+
+MAX_BUCKETS = 50000  # in-memory buckets kept before the least recently used are dropped
+
+
+class TokenBucketLimiter:
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.buckets = OrderedDict()  # key -> (tokens, last_refill)
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+
+    def allow(self, key, rate, burst):
+        """Spends one token from `key`'s bucket. Returns (allowed, retry_after_s)."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                allowed, retry_after = True, 0
+            else:
+                self.buckets[key] = (tokens, now)
+                allowed, retry_after = False, (1 - tokens) / rate
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class RedisTokenBucketLimiter:
+    # Refill and spend atomically on the Redis side; the hash expires once a
+    # full bucket would have refilled, so idle clients cost nothing.
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the 'redis' package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def allow(self, key, rate, burst):
+        allowed, tokens = self.script(keys=[self.prefix + key], args=[rate, burst, time.time()])
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, func):
+        """Runs func() once for all concurrent callers with the same key.
+
+        Returns (result, shared) where shared is True for callers that reused
+        another request's result.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class Counters:
+    def __init__(self):
+        self.values = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+
+    def incr(self, route, name):
+        with self.lock:
+            self.values[route][name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {route: dict(v) for route, v in self.values.items()}
@@ -0,0 +1,10 @@
+import os
+
+# Standalone job worker: run one or more of these next to the web process
+# and set JOB_WORKER_MODE=external on the web side.
+os.environ['JOB_WORKER_MODE'] = 'external'
+
+from server import job_queue
+
+if __name__ == '__main__':
+    job_queue.work()
@@ -13,6 +13,30 @@ const appState = {
     theme: localStorage.getItem('theme') || 'light'
 };
 
+// Session token issued at login, sent with every API call that needs the user
+function authHeaders(extra = {}) {
+    const token = localStorage.getItem('patient_token');
+    return token ? { ...extra, 'Authorization': `Bearer ${token}` } : extra;
+}
+
+// GET a polled endpoint as JSON. A 429 is waited out (Retry-After) and retried
+// a couple of times; any other error rejects so callers keep their current data.
+async function fetchPolled(url, retries = 2) {
+    const res = await fetch(url, { headers: authHeaders() });
+    if (res.status === 429 && retries > 0) {
+        const wait = parseInt(res.headers.get('Retry-After'), 10) || 1;
+        await new Promise(resolve => setTimeout(resolve, wait * 1000));
+        return fetchPolled(url, retries - 1);
+    }
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    return res.json();
+}
+
+// Today's date in the user's timezone as YYYY-MM-DD (booking dates are stored in ISO form)
+function localISODate(d = new Date()) {
+    return `${d.getFullYear()}-${String(d.getMonth() + 1).padStart(2, '0')}-${String(d.getDate()).padStart(2, '0')}`;
+}
+
 // Data: Departments
 // Data: Departments (Icons only)
 const departments = [
@@ -55,15 +79,48 @@ const forms = {
     report: document.getElementById('report-form')
 };
 
+// --- OFFLINE SUPPORT (Service Worker) ---
+function initServiceWorker() {
+    if (!('serviceWorker' in navigator)) return;
+
+    navigator.serviceWorker.register('/sw.js').catch(err => console.error("SW registration failed:", err));
+
+    // Bookings made offline are replayed by the worker once we reconnect;
+    // asking on load as well reports bookings that failed while no page was open
+    const replay = () => navigator.serviceWorker.ready.then(reg => reg.active && reg.active.postMessage({ type: 'replay-bookings' }));
+    window.addEventListener('online', replay);
+
+    navigator.serviceWorker.addEventListener('message', (event) => {
+        if (event.data && event.data.type === 'bookings-replayed') {
+            showToast(`${event.data.count} offline booking(s) sent!`, 'success');
+            if (appState.user) updateUserProfileUI();
+        } else if (event.data && event.data.type === 'bookings-failed') {
+            const expired = event.data.statuses.includes(401);
+            showToast(`${event.data.count} offline booking(s) could not be sent${expired ? ' because your session expired' : ''}. Please log in and book again.`, 'error');
+        }
+    });
+    if (navigator.onLine) replay();
+}
+
+function clearOfflineUserCache() {
+    if (navigator.serviceWorker && navigator.serviceWorker.controller) {
+        navigator.serviceWorker.controller.postMessage({ type: 'clear-user-cache' });
+    }
+}
+
 // --- INITIALIZATION ---
 document.addEventListener('DOMContentLoaded', () => {
+    initServiceWorker();
     initLogin();
     initNavigation();
     initTheme();
 
     // ACTION: Check for Persistent Login
     const saved = localStorage.getItem('patient_user');
-    if (saved) {
+    if (saved && !localStorage.getItem('patient_token')) {
+        // Saved before session tokens existed: ask for a fresh login
+        localStorage.removeItem('patient_user');
+    } else if (saved) {
         try {
             appState.user = JSON.parse(saved);
             console.log("Auto-login success:", appState.user);
@@ -151,6 +208,7 @@ function initLogin() {
                 if (data.status === 'success') {
                     appState.user = data.user;
                     localStorage.setItem('patient_user', JSON.stringify(data.user)); // SAVE SESSION
+                    localStorage.setItem('patient_token', data.token);
                     errorDiv.textContent = "";
 
                     showToast(`Welcome back, ${appState.user.name}!`, 'success');
@@ -186,6 +244,8 @@ function initNavigation() {
         appState.user = null;
         appState.appointments = [];
         localStorage.removeItem('patient_user'); // CLEAR SESSION
+        localStorage.removeItem('patient_token');
+        clearOfflineUserCache();
         forms.login.reset();
         navigateTo('login');
     });
@@ -300,8 +360,7 @@ function renderDashboardContent(view) {
         loading.textContent = 'Loading doctors...';
         container.appendChild(loading);
 
-        fetch('/api/doctors')
-            .then(res => res.json())
+        fetchPolled('/api/doctors')
             .then(doctors => {
                 loading.remove();
                 if (doctors.length === 0) {
@@ -410,7 +469,10 @@ function renderDashboardContent(view) {
         container.innerHTML = `
             <div style="display:flex; justify-content:space-between; align-items:center; margin-bottom:20px;">
                 <h3>Your Appointments</h3>
-                <button class="btn-primary" style="width:auto;" onclick="window.startBooking()">+ Book New</button>
+                <div style="display:flex; gap:10px;">
+                    <button class="nav-btn" style="border:1px solid #ccc; color:#0056b3;" onclick="window.downloadRecords()">⬇ Download Records</button>
+                    <button class="btn-primary" style="width:auto;" onclick="window.startBooking()">+ Book New</button>
+                </div>
             </div>
             <div id="full-apt-list">Loading appointments...</div>
         `;
@@ -418,7 +480,7 @@ function renderDashboardContent(view) {
         const listDiv = document.getElementById('full-apt-list');
 
         // API CALL: Get Appointments
-        fetch(`/api/appointments?mobile=${appState.user.mobile}`)
+        fetch('/api/appointments', { headers: authHeaders() })
             .then(res => res.json())
             .then(data => {
                 appState.appointments = data; // Sync local state
@@ -461,6 +523,19 @@ function renderDashboardContent(view) {
     }
 }
 
+// Full record export: the server returns a signed link to a ZIP that the
+// browser downloads (and can resume) on its own
+window.downloadRecords = function () {
+    if (!appState.user) return;
+    fetch(`${API_URL}/patients/${encodeURIComponent(appState.user.mobile)}/export`, { method: 'POST', headers: authHeaders() })
+        .then(res => res.json().then(data => ({ ok: res.ok, data })))
+        .then(({ ok, data }) => {
+            if (!ok) throw new Error(data.error || 'Export failed');
+            window.location.href = data.url;
+        })
+        .catch(err => showToast(err.message || 'Export failed', 'error'));
+};
+
 function updateQueueUI() {
     const el = document.getElementById('live-queue-num');
     if (el) {
@@ -474,8 +549,8 @@ function updateQueueUI() {
 }
 
 function fetchQueueUpdate() {
-    fetch(`${API_URL}/queue`)
-        .then(res => res.json())
+    // On errors the last known queue stays on screen
+    fetchPolled(`${API_URL}/queue`, 0)
         .then(data => {
             appState.queue = data;
             updateQueueUI();
@@ -530,10 +605,10 @@ function confirmBooking() {
     // API CALL: Book Appointment
     fetch('/api/book', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders({ 'Content-Type': 'application/json' }),
         body: JSON.stringify({
             dept: dept,
-            date: new Date().toLocaleDateString(),
+            date: localISODate(),
             mobile: appState.user.mobile,
             patient_name: appState.user.name,
             patient_age: appState.user.age
@@ -541,8 +616,12 @@ function confirmBooking() {
     })
         .then(res => res.json())
         .then(data => {
-            if (data.status === 'success') {
-                showToast(`Appointment Confirmed! ID: #${data.id}`, 'success');
+            if (data.status === 'queued') {
+                // No connection: the service worker stored it for later
+                showToast("You're offline. Booking saved and will be sent when you're back online; you'll be told if it can't be.", 'info');
+                navigateTo('dashboard');
+            } else if (data.status === 'success') {
+                showToast(`Appointment Confirmed! ID: #${data.id}${data.doctor ? ` with ${data.doctor}` : ''}`, 'success');
                 updateUserProfileUI();
                 navigateTo('dashboard');
                 handleDashboardNav('queue');
@@ -565,7 +644,7 @@ window.viewReport = function (reportId) {
         .then(report => {
             // Fetch appointment details to get doctor name, etc if not in report
             // Also need dept for follow up booking
-            return fetch(`/api/appointments`).then(res => res.json()).then(apts => {
+            return fetch('/api/appointments', { headers: authHeaders() }).then(res => res.json()).then(apts => {
                 const apt = apts.find(a => a.id == report.appointment_id); // Find specific apt if possible, simplified here
                 // Actually the report doesn't have dept info directly unless we join. 
                 // Let's rely on the frontend knowing who they booked with or just pass general.
@@ -635,6 +714,14 @@ function renderReportView(container, report) {
             : ''}
             </div>
 
+            ${report.file_path ? `
+            <div style="margin-bottom:40px;">
+                <h4 style="background:#f8f9fa; padding:10px; border-left:4px solid #8e44ad; margin-bottom:15px;">ATTACHMENT</h4>
+                <a href="/uploads/${report.file_path}" target="_blank" style="color:var(--primary-blue); text-decoration:underline;">
+                    ${report.thumbnail_url ? `<img src="${report.thumbnail_url}" alt="Attachment" style="display:block; max-width:256px; border-radius:4px; border:1px solid #ddd;">` : '📎 View Attachment'}
+                </a>
+            </div>` : ''}
+
             <div style="border-top:1px solid #eee; padding-top:30px; text-align:center; display:flex; justify-content:center; gap:15px;" class="no-print">
                 <button class="btn-primary" onclick="window.print()">🖨 Print / Download PDF</button>
                 <button class="nav-btn" style="border:1px solid #ccc;" onclick="handleDashboardNav('appointments')">Close</button>
@@ -721,8 +808,7 @@ function loadDoctorAppointments() {
     const list = document.getElementById('doc-apt-list');
     list.innerHTML = '<tr><td colspan="6" style="padding:20px; text-align:center;">Loading...</td></tr>';
 
-    fetch('/api/doctor/appointments')
-        .then(res => res.json())
+    fetchPolled('/api/doctor/appointments')
         .then(data => {
             list.innerHTML = '';
             if (data.length === 0) {
@@ -751,6 +837,10 @@ function loadDoctorAppointments() {
             `;
                 list.appendChild(tr);
             });
+        })
+        .catch(err => {
+            console.error(err);
+            list.innerHTML = '<tr><td colspan="6" style="padding:20px; text-align:center;" class="text-red">Could not load appointments. Please try again.</td></tr>';
         });
 }
 
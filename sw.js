@@ -0,0 +1,251 @@
+// Service Worker: offline shell, cached API reads and offline booking queue
+const CACHE_VERSION = 'v1';
+const SHELL_CACHE = `shell-${CACHE_VERSION}`;
+const API_CACHE = `api-${CACHE_VERSION}`;
+
+// Static shell precached on install
+const SHELL_FILES = [
+    '/',
+    '/index.html',
+    '/style.css',
+    '/script.js',
+    '/doctor.html',
+    '/admin.html',
+    '/admin.css',
+    '/admin.js'
+];
+
+// API reads served stale-while-revalidate (everything else goes to the network)
+const SWR_API_PATHS = ['/api/doctors'];
+// Per-user reads that change from other devices (a doctor cancelling, a new
+// booking): network first, cached copy only when offline
+const NETWORK_FIRST_API_PATHS = ['/api/appointments'];
+
+const DB_NAME = 'hospital-offline';
+const OUTBOX = 'outbox';
+const SYNC_TAG = 'replay-bookings';
+
+// --- LIFECYCLE ---
+self.addEventListener('install', (event) => {
+    event.waitUntil(
+        caches.open(SHELL_CACHE)
+            .then(cache => cache.addAll(SHELL_FILES))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(
+                keys.filter(k => k !== SHELL_CACHE && k !== API_CACHE).map(k => caches.delete(k))
+            ))
+            .then(() => self.clients.claim())
+            .then(() => replayBookings())
+    );
+});
+
+// --- FETCH ROUTING ---
+self.addEventListener('fetch', (event) => {
+    const req = event.request;
+    const url = new URL(req.url);
+    if (url.origin !== self.location.origin) return;
+
+    if (req.method === 'POST' && url.pathname === '/api/book') {
+        event.respondWith(bookOrQueue(req));
+        return;
+    }
+    if (req.method !== 'GET') return;
+
+    if (SWR_API_PATHS.includes(url.pathname)) {
+        event.respondWith(staleWhileRevalidate(req, API_CACHE));
+    } else if (NETWORK_FIRST_API_PATHS.includes(url.pathname)) {
+        event.respondWith(networkFirst(req, API_CACHE));
+    } else if (req.mode === 'navigate' && !url.pathname.startsWith('/api/')) {
+        // Pages stay fresh online (admin is served no-cache) and fall back offline.
+        // API navigations (record export downloads) go straight to the network.
+        event.respondWith(networkFirst(req, SHELL_CACHE));
+    } else if (!url.pathname.startsWith('/api/') && !url.pathname.startsWith('/uploads/')) {
+        event.respondWith(staleWhileRevalidate(req, SHELL_CACHE));
+    }
+});
+
+// Per-user API responses are keyed by a hash of the session token so patients
+// sharing a clinic device never see each other's cached appointments.
+async function cacheKey(req) {
+    const auth = req.headers.get('Authorization');
+    if (!auth) return req.url;
+    const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(auth));
+    const hash = Array.from(new Uint8Array(digest).slice(0, 8)).map(b => b.toString(16).padStart(2, '0')).join('');
+    const url = new URL(req.url);
+    url.searchParams.set('__session', hash);
+    return url.toString();
+}
+
+async function staleWhileRevalidate(req, cacheName) {
+    const cache = await caches.open(cacheName);
+    const key = await cacheKey(req);
+    const cached = await cache.match(key, { ignoreVary: true });
+
+    const network = fetch(req)
+        .then(res => {
+            // Never cache errors or 429s from the rate limiter
+            if (res.ok) cache.put(key, res.clone());
+            return res;
+        })
+        .catch(() => null);
+
+    if (cached) return cached;
+    return (await network) || offlineResponse();
+}
+
+async function networkFirst(req, cacheName) {
+    const cache = await caches.open(cacheName);
+    const key = await cacheKey(req);
+    try {
+        const res = await fetch(req);
+        if (res.ok) cache.put(key, res.clone());
+        return res;
+    } catch (e) {
+        const cached = await cache.match(key, { ignoreVary: true });
+        if (cached) return cached;
+        if (req.mode === 'navigate') return (await cache.match('/index.html')) || offlineResponse();
+        return offlineResponse();
+    }
+}
+
+function offlineResponse() {
+    return new Response(JSON.stringify({ error: 'Offline' }), {
+        status: 503,
+        headers: { 'Content-Type': 'application/json' }
+    });
+}
+
+// --- OFFLINE BOOKINGS ---
+async function bookOrQueue(req) {
+    const copy = req.clone();
+    let res;
+    try {
+        res = await fetch(req);
+    } catch (e) {
+        // Network down: keep the booking and replay it on reconnect
+        await addToOutbox({
+            url: copy.url,
+            headers: {
+                'Content-Type': copy.headers.get('Content-Type') || 'application/json',
+                'Authorization': copy.headers.get('Authorization') || ''
+            },
+            body: await copy.text(),
+            queuedAt: Date.now()
+        });
+        if (self.registration.sync) {
+            self.registration.sync.register(SYNC_TAG).catch(() => { });
+        }
+        return new Response(JSON.stringify({ status: 'queued', offline: true }), {
+            status: 202,
+            headers: { 'Content-Type': 'application/json' }
+        });
+    }
+    // Cached appointment lists no longer include this booking
+    if (res.ok) await caches.delete(API_CACHE);
+    return res;
+}
+
+self.addEventListener('sync', (event) => {
+    if (event.tag === SYNC_TAG) event.waitUntil(replayBookings());
+});
+
+self.addEventListener('message', (event) => {
+    const msg = event.data || {};
+    if (msg.type === 'replay-bookings') {
+        event.waitUntil(replayBookings());
+    } else if (msg.type === 'clear-user-cache') {
+        // Logout: drop cached per-user API responses
+        event.waitUntil(caches.delete(API_CACHE));
+    }
+});
+
+let replaying = null;
+function replayBookings() {
+    // One replay at a time so a booking is never sent twice
+    if (!replaying) {
+        replaying = doReplay().finally(() => { replaying = null; });
+    }
+    return replaying;
+}
+
+async function doReplay() {
+    const items = await readOutbox();
+    let sent = 0;
+    for (const item of items) {
+        if (item.failedStatus) continue;
+        let res;
+        try {
+            const headers = { 'Content-Type': item.headers['Content-Type'] };
+            if (item.headers['Authorization']) headers['Authorization'] = item.headers['Authorization'];
+            res = await fetch(item.url, { method: 'POST', headers: headers, body: item.body });
+        } catch (e) {
+            break; // Still offline, keep the rest for the next attempt
+        }
+        if (res.ok) {
+            await removeFromOutbox(item.id);
+            sent++;
+        } else if (res.status >= 400 && res.status < 500 && res.status !== 429) {
+            // Permanent client error (e.g. 401 once the session expired): the
+            // booking will never go through, so keep it until a page is told
+            item.failedStatus = res.status;
+            await putInOutbox(item);
+        } else {
+            break; // 5xx/429: retry later
+        }
+    }
+
+    const clients = await self.clients.matchAll();
+    if (sent > 0) {
+        await caches.delete(API_CACHE);
+        clients.forEach(c => c.postMessage({ type: 'bookings-replayed', count: sent }));
+    }
+    // Failures are dropped only once an open page has been told about them
+    const failed = (await readOutbox()).filter(item => item.failedStatus);
+    if (failed.length && clients.length) {
+        const statuses = failed.map(item => item.failedStatus);
+        clients.forEach(c => c.postMessage({ type: 'bookings-failed', count: failed.length, statuses: statuses }));
+        for (const item of failed) await removeFromOutbox(item.id);
+    }
+}
+
+// --- INDEXEDDB OUTBOX ---
+function openDb() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open(DB_NAME, 1);
+        open.onupgradeneeded = () => open.result.createObjectStore(OUTBOX, { keyPath: 'id', autoIncrement: true });
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function withStore(mode, fn) {
+    const db = await openDb();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction(OUTBOX, mode);
+        const result = fn(tx.objectStore(OUTBOX));
+        tx.oncomplete = () => { db.close(); resolve(result && result.result); };
+        tx.onerror = () => { db.close(); reject(tx.error); };
+    });
+}
+
+function addToOutbox(item) {
+    return withStore('readwrite', store => store.add(item));
+}
+
+function readOutbox() {
+    return withStore('readonly', store => store.getAll());
+}
+
+function putInOutbox(item) {
+    return withStore('readwrite', store => store.put(item));
+}
+
+function removeFromOutbox(id) {
+    return withStore('readwrite', store => store.delete(id));
+}